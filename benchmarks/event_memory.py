@@ -0,0 +1,79 @@
+# Compares the memory used per event by the EventTable columns against the
+# per-event objects the parser used to create.
+#
+#   python3 benchmarks/event_memory.py [-n events]
+
+import os, sys, argparse, tracemalloc
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+
+from pm64_to_midi import EventTable, EventTypes
+
+#-----------------------------------------------------------
+
+# The old ParserEvent layout: one object with an instance __dict__ per event.
+class ObjectEvent:
+	def __init__( self, event_type: int, offset: int, time: int, param1: int, param2: int = None ):
+		self.type = event_type
+		self.offset = offset
+		self.time = time
+
+		if event_type == EventTypes.NOTE_OFF or event_type == EventTypes.NOTE_ON:
+			self.note = param1
+			self.velocity = min( param2, 127 )
+		else:
+			self.control = param1
+			self.value = param2
+
+#-----------------------------------------------------------
+
+def fill_objects( count: int ) -> list:
+	events = []
+
+	for i in range( count // 2 ):
+		events.append( ObjectEvent( EventTypes.NOTE_ON, i * 3, i * 24, 60 + i % 12, 100 ) )
+		events.append( ObjectEvent( EventTypes.NOTE_OFF, i * 3, i * 24 + 500, 60 + i % 12, 100 ) )
+
+	return events
+
+def fill_table( count: int ) -> EventTable:
+	events = EventTable()
+
+	for i in range( count // 2 ):
+		events.append( EventTypes.NOTE_ON, i * 3, i * 24, 60 + i % 12, 100 )
+		events.append( EventTypes.NOTE_OFF, i * 3, i * 24 + 500, 60 + i % 12, 100 )
+
+	return events
+
+def measure( fill, count: int ) -> float:
+	tracemalloc.start()
+	events = fill( count )
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	del events
+	return size / count
+
+#-----------------------------------------------------------
+
+def main():
+	args = argparse.ArgumentParser()
+
+	args.add_argument(
+		'-n', '--events', dest = 'count',
+		type = int, default = 200000,
+		help = 'number of events to create (default: 200000)' )
+
+	args = args.parse_args()
+
+	before = measure( fill_objects, args.count )
+	after = measure( fill_table, args.count )
+
+	print( 'objects:    {:7.1f} bytes/event'.format( before ) )
+	print( 'EventTable: {:7.1f} bytes/event'.format( after ) )
+	print( 'ratio:      {:7.1f}x'.format( before / after ) )
+
+#-----------------------------------------------------------
+
+if __name__ == '__main__':
+	main()
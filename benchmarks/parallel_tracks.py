@@ -0,0 +1,85 @@
+# Compares converting a synthetic BGM with its tracks parsed serially against
+# parsing them in worker processes (-j), for growing amounts of track data,
+# to show from which song size the process pool pays for its startup. Every
+# parallel conversion is checked to produce the same bytes as the serial one.
+#
+#   python3 benchmarks/parallel_tracks.py [synth options] [-j 2,4] [--sizes 16,64,256] [-r repeat]
+
+import os, sys, io, argparse, time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+
+from pm64_to_midi import ConvertOptions, convert_to_stream
+from synth_bgm import add_synth_arguments, make_bgm, synth_params
+
+#-----------------------------------------------------------
+
+# Return the best time of `repeat` conversions and the MIDI bytes produced.
+def best_time( data: bytes, options: ConvertOptions, jobs: int, repeat: int ) -> tuple:
+	best = None
+
+	for i in range( repeat ):
+		out = io.BytesIO()
+		start = time.perf_counter()
+		convert_to_stream( data, 0, out, options, jobs = jobs )
+		seconds = time.perf_counter() - start
+
+		if best is None or seconds < best:
+			best = seconds
+
+	return best, out.getvalue()
+
+#-----------------------------------------------------------
+
+def int_list( value: str ) -> list:
+	return [int( item ) for item in value.split( ',' )]
+
+def main():
+	args = argparse.ArgumentParser()
+
+	add_synth_arguments( args )
+	args.add_argument(
+		'-t', '--translate-drums', action = 'store_true',
+		help = 'translate drum mapping to GS drum mapping' )
+	args.add_argument(
+		'-j', '--jobs', dest = 'jobs',
+		type = int_list, default = [2, 4],
+		help = 'comma-separated worker process counts to try (default: 2,4)' )
+	args.add_argument(
+		'--sizes', dest = 'sizes',
+		type = int_list, default = [16, 64, 256],
+		help = 'comma-separated notes per track per subsegment; overrides --notes (default: 16,64,256)' )
+	args.add_argument(
+		'-r', '--repeat', dest = 'repeat',
+		type = int, default = 3,
+		help = 'repetitions; the best time is kept (default: 3)' )
+
+	args = args.parse_args()
+	options = ConvertOptions( args.translate_drums )
+
+	print( 'CPUs: {}'.format( os.cpu_count() ) )
+	print( '{:>6s} {:>9s} {:>10s}'.format( 'notes', 'BGM bytes', 'serial ms' ) +
+		''.join( ' {:>10s} {:>7s}'.format( '-j {:d} ms'.format( jobs ), 'speedup' ) for jobs in args.jobs ) )
+
+	for notes in args.sizes:
+		params = synth_params( args )
+		params['notes'] = notes
+		data = make_bgm( **params )
+
+		serial, expected = best_time( data, options, 1, args.repeat )
+		results = [best_time( data, options, jobs, args.repeat ) for jobs in args.jobs]
+
+		line = '{:6d} {:9d} {:10.1f}'.format( notes, len( data ), serial * 1000 )
+
+		for seconds, midi in results:
+			if midi != expected:
+				sys.exit( 'Parallel conversion of {:d} notes differs from the serial one'.format( notes ) )
+
+			line += ' {:10.1f} {:6.2f}x'.format( seconds * 1000, serial / seconds )
+
+		print( line )
+
+#-----------------------------------------------------------
+
+if __name__ == '__main__':
+	main()
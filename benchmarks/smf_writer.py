@@ -0,0 +1,99 @@
+# Checks that the native SMF writer produces the same bytes as building the
+# file through mido, and compares how long each takes.
+#
+#   python3 benchmarks/smf_writer.py [-t] [-r repeat] bgm_file...
+
+import os, sys, io, argparse, time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+
+import mido
+from pm64_to_midi import BgmReader, ConvertOptions, get_segments, parse_song, track2midi, write_smf
+
+#-----------------------------------------------------------
+
+def write_mido( tracks: list ) -> bytes:
+	mid_f = mido.MidiFile( type = 1 )
+	mid_f.ticks_per_beat = 48
+
+	for track in tracks:
+		m_track = mido.MidiTrack()
+		mid_f.tracks.append( m_track )
+		track2midi( track, m_track )
+
+	out = io.BytesIO()
+	mid_f.save( file = out )
+	return out.getvalue()
+
+def best_time( func, tracks: list, repeat: int ) -> float:
+	best = None
+
+	for i in range( repeat ):
+		start = time.perf_counter()
+		func( tracks )
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min( best, elapsed )
+
+	return best
+
+#-----------------------------------------------------------
+
+def main():
+	args = argparse.ArgumentParser()
+
+	args.add_argument(
+		'-t', '--translate-drums', action = 'store_true',
+		help = 'translate drum mapping to GS drum mapping' )
+	args.add_argument(
+		'-r', '--repeat', dest = 'repeat',
+		type = int, default = 5,
+		help = 'timing repetitions per song (default: 5)' )
+	args.add_argument(
+		'in_files', nargs = '+',
+		help = 'BGM files' )
+
+	args = args.parse_args()
+	options = ConvertOptions( args.translate_drums )
+
+	mismatches = 0
+	mido_total = 0
+	native_total = 0
+
+	for in_file in args.in_files:
+		reader = BgmReader.open( in_file )
+
+		for segment in get_segments( reader ):
+			try:
+				parser = parse_song( reader, segment, options )
+			except Exception as e:
+				print( 'SKIP  {} segment {:d}: {}'.format( in_file, segment, e ) )
+				continue
+
+			tracks = [track for track in parser.tracks if len( track.events ) != 0]
+
+			try:
+				expected = write_mido( tracks )
+			except ValueError as e:
+				print( 'SKIP  {} segment {:d}: mido rejects output ({})'.format( in_file, segment, e ) )
+				continue
+
+			if write_smf( tracks ) != expected:
+				mismatches += 1
+				print( 'DIFF  {} segment {:d}'.format( in_file, segment ) )
+				continue
+
+			mido_total += best_time( write_mido, tracks, args.repeat )
+			native_total += best_time( write_smf, tracks, args.repeat )
+			print( 'OK    {} segment {:d}'.format( in_file, segment ) )
+
+	if native_total > 0:
+		print( 'mido:   {:8.2f} ms'.format( mido_total * 1000 ) )
+		print( 'native: {:8.2f} ms ({:.1f}x faster)'.format( native_total * 1000, mido_total / native_total ) )
+
+	if mismatches:
+		sys.exit( '{:d} segment(s) differ'.format( mismatches ) )
+
+#-----------------------------------------------------------
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,136 @@
+# Times the conversion phases on a synthetic BGM: header/EX table loading,
+# subsegment parsing, sorting/merging, fade expansion, optimization and MIDI
+# serialization, plus the whole conversion. Results can be written as JSON
+# and compared to an earlier run.
+#
+#   python3 benchmarks/suite.py [synth options] [-t] [--optimize] [-r repeat] [--json out.json] [--baseline old.json]
+
+import os, sys, io, argparse, json, platform, time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+
+from pm64_to_midi import ConvertOptions, ConvertStats, convert_to_stream
+from synth_bgm import add_synth_arguments, make_bgm, synth_params
+
+PHASES = list( ConvertStats.PHASES ) + [ 'total' ]
+
+# phases measured against the MIDI bytes they produce instead of the BGM bytes
+OUTPUT_PHASES = ( 'midi_build', 'save' )
+
+#-----------------------------------------------------------
+
+# convert once, returning the time taken by each phase and the amount of data
+# handled. The phases interleave as rows stream through the converter, so
+# they are timed by its own --stats instrumentation, and the total without it
+def run_phases( data: bytes, options: ConvertOptions ) -> dict:
+	stats = ConvertStats()
+	out = io.BytesIO()
+	convert_to_stream( data, 0, out, options, stats )
+	times = dict( stats.times )
+
+	start = time.perf_counter()
+	convert_to_stream( data, 0, io.BytesIO(), options )
+	times['total'] = time.perf_counter() - start
+
+	return { 'times': times, 'events': sum( stats.events ), 'bgm_bytes': len( data ), 'midi_bytes': len( out.getvalue() ) }
+
+#-----------------------------------------------------------
+
+def summarize( data: bytes, options: ConvertOptions, repeat: int ) -> dict:
+	best = None
+
+	for i in range( repeat ):
+		run = run_phases( data, options )
+
+		if best is None:
+			best = run
+		else:
+			for phase in PHASES:
+				best['times'][phase] = min( best['times'][phase], run['times'][phase] )
+
+	results = {}
+
+	for phase in PHASES:
+		seconds = best['times'][phase]
+		# parsing consumes BGM bytes, serializing produces MIDI bytes
+		size = best['midi_bytes'] if phase in OUTPUT_PHASES else best['bgm_bytes']
+
+		results[phase] = {
+			'seconds'		: seconds,
+			'events_per_s'	: best['events'] / seconds if seconds > 0 else None,
+			'bytes_per_s'	: size / seconds if seconds > 0 else None,
+		}
+
+	return {
+		'events'	: best['events'],
+		'bgm_bytes'	: best['bgm_bytes'],
+		'midi_bytes': best['midi_bytes'],
+		'phases'	: results,
+	}
+
+#-----------------------------------------------------------
+
+def main():
+	args = argparse.ArgumentParser()
+
+	add_synth_arguments( args )
+	args.add_argument(
+		'-t', '--translate-drums', action = 'store_true',
+		help = 'translate drum mapping to GS drum mapping' )
+	args.add_argument(
+		'--optimize', action = 'store_true',
+		help = 'drop redundant events, timing the optimize phase' )
+	args.add_argument(
+		'-r', '--repeat', dest = 'repeat',
+		type = int, default = 5,
+		help = 'repetitions; the best time of each phase is kept (default: 5)' )
+	args.add_argument(
+		'--json', dest = 'json_file',
+		help = 'write the results to this JSON file' )
+	args.add_argument(
+		'--baseline', dest = 'baseline_file',
+		help = 'compare against results from an earlier --json run' )
+
+	args = args.parse_args()
+
+	params = synth_params( args )
+	data = make_bgm( **params )
+	options = ConvertOptions( args.translate_drums, optimize = args.optimize )
+
+	summary = summarize( data, options, args.repeat )
+
+	report = {
+		'params'	: dict( params, translate_drums = args.translate_drums, optimize = args.optimize ),
+		'python'	: platform.python_version(),
+		'summary'	: summary,
+	}
+
+	baseline = None
+
+	if args.baseline_file is not None:
+		with open( args.baseline_file ) as f:
+			baseline = json.load( f )['summary']['phases']
+
+	print( '{:d} events, {:d} BGM bytes, {:d} MIDI bytes'.format(
+		summary['events'], summary['bgm_bytes'], summary['midi_bytes'] ) )
+	print( '{:12s} {:>10s} {:>12s} {:>12s}{}'.format(
+		'phase', 'ms', 'events/s', 'bytes/s', '  vs baseline' if baseline else '' ) )
+
+	for phase in PHASES:
+		result = summary['phases'][phase]
+		line = '{:12s} {:10.2f} {:12.0f} {:12.0f}'.format(
+			phase, result['seconds'] * 1000, result['events_per_s'] or 0, result['bytes_per_s'] or 0 )
+
+		if baseline and phase in baseline and baseline[phase]['seconds'] and result['seconds'] > 0:
+			line += '  {:6.2f}x'.format( baseline[phase]['seconds'] / result['seconds'] )
+
+		print( line )
+
+	if args.json_file is not None:
+		with open( args.json_file, 'w' ) as f:
+			json.dump( report, f, indent = '\t' )
+
+#-----------------------------------------------------------
+
+if __name__ == '__main__':
+	main()
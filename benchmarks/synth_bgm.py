@@ -0,0 +1,228 @@
+# Generates synthetic BGM files for benchmarking. The amount of work a file
+# takes to convert is scaled by the number of subsegments, note density,
+# detour nesting, tempo fades and drum tracks.
+#
+#   python3 benchmarks/synth_bgm.py [options] -o bgm_file
+
+import os, sys, argparse, random, struct
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+
+from pm64_to_midi import cmd_len_table, drum_map
+
+#-----------------------------------------------------------
+
+# EX drum samples listed in the drum table, available as drum notes 72+
+EX_DRUMS = [0x9a, 0xb3, 0xc9, 0xd6]
+EX_PATCHES = [( 0, 10 ), ( 1, 20 ), ( 2, 30 )]
+
+# commands with plain operands that the synthetic tracks sprinkle in
+PLAIN_CMDS = [0xe9, 0xea, 0xeb, 0xec, 0xed, 0xee, 0xf0, 0xf1, 0xf2, 0xf4, 0xf7]
+
+#-----------------------------------------------------------
+
+def u16( value: int ) -> bytes:
+	return struct.pack( '>H', value & 0xffff )
+
+def pad4( data: bytearray ) -> None:
+	while len( data ) % 4:
+		data.append( 0 )
+
+#-----------------------------------------------------------
+
+def note_cmd( rng: random.Random, is_drum: bool ) -> bytes:
+	if is_drum:
+		note = rng.choice( list( drum_map ) + [72 + i for i in range( len( EX_DRUMS ) )] )
+	else:
+		note = rng.randrange( 24, 0x54 )
+
+	out = bytearray( ( 0x80 | note, rng.randrange( 40, 128 ) ) )
+
+	# long lengths take a second byte
+	if rng.random() < 0.1:
+		length = rng.randrange( 0xc0, 0x1000 ) - 0xc0
+		out += bytes( ( 0xc0 | ( length >> 8 ), length & 0xff ) )
+	else:
+		out.append( rng.randrange( 1, 0xc0 ) )
+
+	return bytes( out )
+
+def delta_cmd( rng: random.Random ) -> bytes:
+	# long delta times take a second byte
+	if rng.random() < 0.05:
+		delta = rng.randrange( 0x78, 0x400 ) - 0x78
+		return bytes( ( 0x78 | ( delta >> 8 ), delta & 0xff ) )
+
+	return bytes( ( rng.randrange( 1, 0x30 ), ) )
+
+def other_cmd( rng: random.Random, is_drum: bool ) -> bytes:
+	choice = rng.random()
+
+	if choice < 0.2 and not is_drum:
+		return bytes( ( 0xf5, rng.randrange( len( EX_PATCHES ) ) ) )
+	elif choice < 0.3 and not is_drum:
+		return bytes( ( 0xe8, rng.randrange( 3 ), rng.randrange( 128 ) ) )
+	elif choice < 0.4:
+		return bytes( ( 0xef, ) ) + struct.pack( '>h', rng.randrange( -200, 200 ) )
+
+	cmd = rng.choice( PLAIN_CMDS )
+
+	if cmd == 0xed or cmd == 0xee:
+		return bytes( ( cmd, rng.randrange( 0, 4 ) ) )
+
+	return bytes( ( cmd, ) ) + bytes( rng.randrange( 128 ) for i in range( cmd_len_table[cmd - 0xe0] ) )
+
+def phrase( rng: random.Random, notes: int, is_drum: bool ) -> bytearray:
+	out = bytearray()
+
+	for i in range( notes ):
+		out += note_cmd( rng, is_drum )
+		out += delta_cmd( rng )
+
+		if rng.random() < 0.15:
+			out += other_cmd( rng, is_drum )
+
+	return out
+
+#-----------------------------------------------------------
+
+# Build a BGM whose one segment plays `subsegments` distinct subsegments of
+# `tracks` tracks, the last `drum_tracks` in drum mode, each detouring into
+# `detour_depth` nested shared phrases.
+def make_bgm( subsegments: int = 8, tracks: int = 8, notes: int = 64, detour_depth: int = 2,
+	tempo_fades: int = 4, drum_tracks: int = 2, seed: int = 0 ) -> bytes:
+	rng = random.Random( seed )
+	data = bytearray( b'BGM ' + bytes( 0x20 ) )
+
+	# ------------------------------------------------
+	# shared phrases: level n detours into level n - 1
+
+	chains = {}
+
+	for is_drum in ( False, True ):
+		target = None
+
+		for level in range( detour_depth ):
+			body = phrase( rng, 2, is_drum )
+			nested = 0
+
+			# a nested detour must not be the last command, or the enclosing
+			# detour would run out before its operands are read
+			if target is not None:
+				body += bytes( ( 0xfe, ) ) + u16( target[0] ) + bytes( ( target[1], ) )
+				nested = 1
+
+			body += phrase( rng, 2, is_drum )
+
+			# only the detour opcode itself counts against the enclosing detour
+			target = ( len( data ), len( body ) - 2 * nested )
+			data += body
+
+		chains[is_drum] = target
+
+	pad4( data )
+
+	# ------------------------------------------------
+	# EX drum and patch tables
+
+	drums_ofs = len( data )
+
+	for sample in EX_DRUMS:
+		data += bytes( ( 0, sample ) ) + bytes( 10 )
+
+	patch_ofs = len( data )
+
+	for bank, patch in EX_PATCHES:
+		data += bytes( ( bank, patch ) ) + bytes( 6 )
+
+	data[0x1c:0x24] = u16( drums_ofs >> 2 ) + u16( len( EX_DRUMS ) ) + u16( patch_ofs >> 2 ) + u16( len( EX_PATCHES ) )
+
+	# ------------------------------------------------
+	# segment command list
+
+	pad4( data )
+	seg_ofs = len( data )
+	data[0x14:0x16] = u16( seg_ofs >> 2 )
+	data += bytes( 4 * ( subsegments + 1 ) )
+
+	fades_left = tempo_fades
+
+	for sub in range( subsegments ):
+		pad4( data )
+		sub_ofs = len( data )
+		struct.pack_into( '>HH', data, seg_ofs + sub * 4, 0x3000, ( sub_ofs - seg_ofs ) >> 2 )
+		data += bytes( 64 )
+
+		for channel in range( min( tracks, 16 ) ):
+			is_drum = channel >= tracks - drum_tracks
+			body = bytearray()
+
+			if channel == 0:
+				body += bytes( ( 0xe0, ) ) + u16( rng.randrange( 90, 180 ) )
+
+				# spread the fades evenly over the subsegments
+				fades = fades_left // ( subsegments - sub )
+				fades_left -= fades
+
+				for i in range( fades ):
+					body += bytes( ( 0xe4, ) ) + u16( rng.randrange( 24, 192 ) ) + u16( rng.randrange( 90, 180 ) )
+					body += bytes( ( 0x60, ) )
+
+			body += phrase( rng, notes // 2, is_drum )
+
+			if chains[is_drum] is not None:
+				target, length = chains[is_drum]
+				body += bytes( ( 0xfe, ) ) + u16( target ) + bytes( ( length, ) )
+
+			body += phrase( rng, notes - notes // 2, is_drum )
+			body.append( 0 )
+
+			struct.pack_into( '>HH', data, sub_ofs + channel * 4, len( data ) - sub_ofs, 0x80 if is_drum else 0 )
+			data += body
+
+	if len( data ) > 0x3ffff:
+		raise ValueError( 'synthetic BGM too large for 16-bit offsets; use fewer notes or subsegments' )
+
+	return bytes( data )
+
+#-----------------------------------------------------------
+
+def add_synth_arguments( args: argparse.ArgumentParser ) -> None:
+	args.add_argument( '--subsegments', type = int, default = 8, help = 'subsegments in the segment (default: 8)' )
+	args.add_argument( '--tracks', type = int, default = 8, help = 'tracks with data, up to 16 (default: 8)' )
+	args.add_argument( '--notes', type = int, default = 64, help = 'notes per track per subsegment (default: 64)' )
+	args.add_argument( '--detour-depth', type = int, default = 2, help = 'nesting depth of shared phrases (default: 2)' )
+	args.add_argument( '--tempo-fades', type = int, default = 4, help = 'tempo fades in the song (default: 4)' )
+	args.add_argument( '--drum-tracks', type = int, default = 2, help = 'tracks in drum mode (default: 2)' )
+	args.add_argument( '--seed', type = int, default = 0, help = 'random seed (default: 0)' )
+
+def synth_params( args: argparse.Namespace ) -> dict:
+	return {
+		'subsegments'	: args.subsegments,
+		'tracks'		: args.tracks,
+		'notes'			: args.notes,
+		'detour_depth'	: args.detour_depth,
+		'tempo_fades'	: args.tempo_fades,
+		'drum_tracks'	: args.drum_tracks,
+		'seed'			: args.seed,
+	}
+
+#-----------------------------------------------------------
+
+def main():
+	args = argparse.ArgumentParser()
+
+	add_synth_arguments( args )
+	args.add_argument(
+		'-o', '--out', dest = 'out_file',
+		help = 'BGM file name', required = True )
+
+	args = args.parse_args()
+
+	with open( args.out_file, 'wb' ) as f:
+		f.write( make_bgm( **synth_params( args ) ) )
+
+#-----------------------------------------------------------
+
+if __name__ == '__main__':
+	main()
@@ -1,20 +1,50 @@
-import mido, sys, argparse
-from enum import Enum
+import sys, os, io, argparse, mmap, glob, struct, hashlib, json, time, base64, warnings
+import collections, heapq, itertools
+from enum import IntEnum
+from array import array
 from typing import List, BinaryIO
 
+# modules only some commands need (mido, asyncio, concurrent.futures and
+# tracemalloc) are imported where they are used, as importing them takes
+# longer than converting a small song
+
+# only needed by convert(), track2midi and playing to a MIDI port; the CLI
+# writes MIDI files itself. Set by import_mido
+mido = None
+
+# Import mido on first use, returning None if it is not installed
+def import_mido():
+	global mido
+
+	if mido is None:
+		try:
+			import mido as module
+		except ImportError:
+			return None
+		mido = module
+
+	return mido
+
+#-----------------------------------------------------------
+
+# raised for songs that can't be converted, such as a segment the song
+# doesn't have or a drum that isn't mapped, so callers can keep running
+class BgmFormatError( ValueError ):
+	pass
+
+# warned about things in a song that are converted as well as possible
+class BgmWarning( UserWarning ):
+	pass
+
 #-----------------------------------------------------------
 
 PITCH_STEP_COARSE	= 8192 / 24
 PITCH_STEP_FINE		= PITCH_STEP_COARSE / 100
 
-cmd_len_table = [
-	2, 1, 1, 1, 4, 3, 2, 0,
-	2, 1, 1, 1, 1, 1, 1, 2,
-	3, 1, 1, 0, 2, 1, 3, 1,
-	0, 0, 0, 0, 3, 3, 3, 3
-]
+# GS address of the master volume, followed by the volume in sysex events
+MASTER_VOLUME_SYSEX	= ( 0x40, 0x00, 0x04 )
 
-class EventTypes( Enum ):
+class EventTypes( IntEnum ):
 	NOTE_OFF	= 0
 	NOTE_ON		= 1
 	CC			= 2
@@ -23,6 +53,10 @@ class EventTypes( Enum ):
 	TEMPO		= 5
 	TEMPO_FADE	= 6
 	SYSEX		= 7
+	MARKER		= 8
+	MASTER_VOLUME_FADE	= 9
+	SUBVOLUME_FADE		= 10
+	TREMOLO				= 11
 
 #-----------------------------------------------------------
 
@@ -196,46 +230,134 @@ drum_ex_map = {
 
 #-----------------------------------------------------------
 
-patch_ex_map = {}
+# Parser events stored as columns: time, type, offset, param1 and param2.
+# The params are:
+#
+# NOTE_ON/NOTE_OFF  note, velocity
+# CC                control, value
+# PROGRAM           bank, program
+# WHEEL             pitch
+# TEMPO             microseconds per beat
+# TEMPO_FADE        fade time, target BPM
+# SYSEX             index into `data`
+# MARKER            index into `data`
+# MASTER_VOLUME_FADE  fade time, target volume
+# SUBVOLUME_FADE    fade time, target subvolume
+# TREMOLO           delay, depth
+class EventTable:
+	def __init__( self ):
+		self.time	= array( 'i' )
+		self.type	= array( 'b' )
+		self.offset	= array( 'i' )
+		self.param1	= array( 'i' )
+		self.param2	= array( 'i' )
+		self.data	: List[tuple] = []
+
+	def __len__( self ) -> int:
+		return len( self.time )
+
+	def append( self, event_type: int, offset: int, time: int, param1: int, param2: int = 0 ) -> None:
+		self.time.append( time )
+		self.type.append( event_type )
+		self.offset.append( offset )
+		self.param1.append( param1 )
+		self.param2.append( param2 )
+
+	def append_sysex( self, offset: int, time: int, data: tuple ) -> None:
+		self.append( EventTypes.SYSEX, offset, time, len( self.data ) )
+		self.data.append( data )
+
+	def append_marker( self, offset: int, time: int, text: str ) -> None:
+		self.append( EventTypes.MARKER, offset, time, len( self.data ) )
+		self.data.append( text )
+
+	def columns( self ) -> tuple:
+		return ( self.time, self.type, self.offset, self.param1, self.param2 )
+
+	# Yield each event as a ( time, type, offset, param1, param2 ) tuple. For
+	# SYSEX and MARKER rows param1 is the payload itself rather than an index
+	def rows( self ):
+		data = self.data
+
+		for row in zip( self.time, self.type, self.offset, self.param1, self.param2 ):
+			if row[1] == EventTypes.SYSEX or row[1] == EventTypes.MARKER:
+				row = ( row[0], row[1], row[2], data[row[3]], row[4] )
+			yield row
+
+	@classmethod
+	def from_rows( cls, rows ) -> 'EventTable':
+		table = cls()
+
+		for time, event_type, offset, param1, param2 in rows:
+			if event_type == EventTypes.SYSEX or event_type == EventTypes.MARKER:
+				table.data.append( param1 )
+				param1 = len( table.data ) - 1
+
+			table.append( event_type, offset, time, param1, param2 )
+
+		return table
+
+	# stable sort by time; the rows of one subsegment track are nearly in order already
+	def sort( self ) -> None:
+		self.permute( sorted( range( len( self ) ), key = self.time.__getitem__ ) )
+
+	# Copy the rows from `start` onwards, with times made relative to `time_base`
+	def extract( self, start: int, time_base: int ) -> 'EventTable':
+		table = EventTable()
+		table.time		= array( 'i', [time - time_base for time in self.time[start:]] )
+		table.type		= self.type[start:]
+		table.offset	= self.offset[start:]
+		table.param1	= self.param1[start:]
+		table.param2	= self.param2[start:]
+
+		for i, event_type in enumerate( table.type ):
+			if event_type == EventTypes.SYSEX or event_type == EventTypes.MARKER:
+				table.param1[i] = len( table.data )
+				table.data.append( self.data[self.param1[start + i]] )
+
+		return table
+
+	# Append all rows of `other`, shifted later by `time_offset` ticks
+	def extend( self, other: 'EventTable', time_offset: int ) -> None:
+		first = len( self )
+		data_base = len( self.data )
+
+		self.time.extend( array( 'i', [time + time_offset for time in other.time] ) )
+		self.type.extend( other.type )
+		self.offset.extend( other.offset )
+		self.param1.extend( other.param1 )
+		self.param2.extend( other.param2 )
+
+		if other.data:
+			for i, event_type in enumerate( other.type ):
+				if event_type == EventTypes.SYSEX or event_type == EventTypes.MARKER:
+					self.param1[first + i] += data_base
+
+			self.data.extend( other.data )
+
+	# Drop all rows from `count` onwards
+	def truncate( self, count: int ) -> None:
+		for column in self.columns():
+			del column[count:]
+
+	# Reorder the rows from `start` onwards so that row start+i becomes row order[i]
+	def permute( self, order: List[int], start: int = 0 ) -> None:
+		for column in self.columns():
+			column[start:] = array( column.typecode, [column[i] for i in order] )
 
 #-----------------------------------------------------------
 
-class ParserEvent:
-	def __init__( self, event_type: int, offset: int, time: int, param1: int, param2: int = None ):
-		self.type = event_type
-		self.offset = offset
-		self.time = time
+def bpm_to_tempo( bpm: float ) -> int:
+	return int( round( 60000000 / bpm ) )
 
-		if   event_type == EventTypes.CC:
-			self.control = param1
-			self.value = param2
-		elif event_type == EventTypes.NOTE_OFF:
-			self.note = param1
-			self.velocity = min( param2, 127 )
-		elif event_type == EventTypes.NOTE_ON:
-			self.note = param1
-			self.velocity = min( param2, 127 )
-		elif event_type == EventTypes.PROGRAM:
-			self.control = 0
-			self.value = param1
-			self.program = min( param2, 127 )
-		elif event_type == EventTypes.WHEEL:
-			self.pitch = param1
-		elif event_type == EventTypes.TEMPO:
-			self.tempo = param1
-		elif event_type == EventTypes.TEMPO_FADE:
-			self.fade_time = param1
-			self.target = param2
-		elif event_type == EventTypes.SYSEX:
-			self.data = param1
+def tempo_to_bpm( tempo: int ) -> float:
+	return 60000000 / tempo
 
 #-----------------------------------------------------------
 
 class ParserTrack:
 	def __init__( self, channel: int ):
-		self.events			: List[ParserEvent] = []
-		self.detour_remain	= 0
-		self.ret_pos		= 0
+		self.events			= EventTable()
 		self.time_at		= 0
 		self.channel		= channel
 		self.coarse_tune	= 0
@@ -245,16 +367,67 @@ class ParserTrack:
 		self.patch_bank		= 0
 		self.patch			= None
 
-	def sort_events_by_time( self ) -> None:
-		self.events.sort( key = lambda x: x.time )
+	# The parts of the track state that change what parsing emits
+	def get_state( self ) -> tuple:
+		return ( self.coarse_tune, self.fine_tune, self.tuning, self.drum_active, self.patch_bank, self.patch )
+
+	def set_state( self, state: tuple ) -> None:
+		self.coarse_tune, self.fine_tune, self.tuning, self.drum_active, self.patch_bank, self.patch = state
+
+#-----------------------------------------------------------
+
+class ConvertOptions:
+	def __init__( self, translate_drums: bool = False, tempo_fade_step: int = 1, tempo_fade_bpm: float = 0,
+		unroll: int = 1, loop_cc111: bool = False, smf_format: int = 1, optimize: bool = False,
+		ramp_step: int = 1, ramp_threshold: int = 1, tremolo: bool = False ):
+		self.translate_drums	= translate_drums
+		self.tempo_fade_step	= tempo_fade_step
+		self.tempo_fade_bpm		= tempo_fade_bpm
+		self.unroll				= unroll
+		self.loop_cc111			= loop_cc111
+		self.smf_format			= smf_format
+		self.optimize			= optimize
+		self.ramp_step			= ramp_step
+		self.ramp_threshold		= ramp_threshold
+		self.tremolo			= tremolo
 
 #-----------------------------------------------------------
 
+# per-song state; fork() gives another segment of the same song a parser
+# sharing its EX tables
 class Parser:
-	def __init__( self ):
+	def __init__( self, options: ConvertOptions = None ):
+		self.options			= options if options is not None else ConvertOptions()
 		self.next_channel		= 0
 		self.tracks				: List[ParserTrack] = []
+		self.drum_table			= [drum_map.get( note ) for note in range( 128 )]
+		self.patch_ex_map		= {}
 		self.next_empty_drum	= 72
+		self.subseg_cache		= {}
+		# parsed detour phrases by target, length and the track state they
+		# use, and the scan_phrase result for each target and length
+		self.detour_cache		= {}
+		self.phrases			= {}
+		self.tables_loaded		= False
+		# events dropped by optimize_rows, by type
+		self.removed			= [0] * len( EventTypes )
+
+	# a Parser without tracks sharing the EX tables, and the caches too
+	# unless `options` differ, since those change the cached events
+	def fork( self, options: ConvertOptions = None ) -> 'Parser':
+		parser = Parser( self.options if options is None else options )
+		parser.drum_table		= self.drum_table
+		parser.patch_ex_map		= self.patch_ex_map
+		parser.next_empty_drum	= self.next_empty_drum
+		parser.phrases			= self.phrases
+		parser.tables_loaded	= self.tables_loaded
+
+		if vars( parser.options ) == vars( self.options ):
+			parser.subseg_cache	= self.subseg_cache
+			parser.detour_cache	= self.detour_cache
+			parser.removed		= self.removed
+
+		return parser
 
 	def add_track( self ) -> None:
 		self.tracks.append( ParserTrack( self.next_channel ) )
@@ -262,104 +435,881 @@ class Parser:
 
 	def add_drum( self, sample ) -> None:
 		if self.next_empty_drum > 100:
-			sys.exit( "Exceeded drum_limit" )
+			raise BgmFormatError( 'Exceeded drum_limit' )
 
 		if not sample in drum_ex_map:
 			note = self.next_empty_drum - 72
 
-			print( 'Translation of EX drum {:02X} is not supported yet'.format( sample ) )
-			print( 'Will default to MIDI note {:d}'.format( note ) )
+			warnings.warn( 'Translation of EX drum {:02X} is not supported yet; will default to MIDI note {:d}'.format(
+				sample, note ), BgmWarning )
 
-			drum_map[self.next_empty_drum] = ( note, 0 )
+			self.drum_table[self.next_empty_drum] = ( note, 0 )
 		else:
 			drum_info = drum_ex_map[sample]
-			drum_map[self.next_empty_drum] = drum_info
+			self.drum_table[self.next_empty_drum] = drum_info
 
 		self.next_empty_drum += 1
-		
+
+	def add_patch( self, bank: int, patch: int ) -> None:
+		self.patch_ex_map[len( self.patch_ex_map )] = ( bank, patch )
 
 #-----------------------------------------------------------
 
-def read_int( f: BinaryIO, width: int, signed: bool ) -> int:
-	return int.from_bytes( f.read( width ), byteorder = 'big', signed = signed )
+def map_file( f: BinaryIO ):
+	# map an open file read-only. Empty files, pipes and file-like objects
+	# without a descriptor cannot be mapped, so those are read whole instead
+	try:
+		return mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+	except ( AttributeError, ValueError, OSError ):
+		return f.read()
+
+# Cursor over a BGM file in memory. Detours followed byte by byte keep
+# their countdown here, with a stack so nested detours resume the outer one
+class BgmReader:
+	def __init__( self, data ):
+		self.data			= memoryview( data )
+		self.size			= len( self.data )
+		self.pos			= 0
+		self.detour_remain	= 0
+		self.ret_stack		: List[tuple] = []
+
+	@classmethod
+	def open( cls, path: str ) -> 'BgmReader':
+		with open( path, 'rb' ) as f:
+			return cls.from_file( f )
+
+	@classmethod
+	def from_file( cls, f: BinaryIO ) -> 'BgmReader':
+		return cls( map_file( f ) )
+
+	def seek( self, pos: int ) -> None:
+		self.pos = pos
+
+	def tell( self ) -> int:
+		return self.pos
+
+	def skip( self, count: int ) -> None:
+		self.pos += count
+
+	def reset_detour( self ) -> None:
+		self.detour_remain = 0
+		self.ret_stack.clear()
+
+	def u8( self ) -> int:
+		pos = self.pos
+		self.pos = pos + 1
+
+		# reads past the end yield 0, which terminates a track
+		if pos >= self.size:
+			return 0
+		return self.data[pos]
+
+	def read_int( self, width: int, signed: bool ) -> int:
+		pos = self.pos
+		self.pos = pos + width
+		return int.from_bytes( self.data[pos:pos + width], byteorder = 'big', signed = signed )
+
+	def u16( self ) -> int:
+		return self.read_int( 2, False )
+
+	def unpack( self, fmt: struct.Struct ) -> tuple:
+		pos = self.pos
+		self.pos = pos + fmt.size
+
+		if pos + fmt.size > self.size:
+			# like u8, pad reads past the end with zeros
+			return fmt.unpack( bytes( self.data[pos:self.size] ).ljust( fmt.size, b'\0' ) )
+		return fmt.unpack_from( self.data, pos )
+
+	# Read one byte of track data, counting it against any active detour
+	def next_byte( self ) -> int:
+		value = self.u8()
+		if self.detour_remain > 0:
+			self.step_detour( 1 )
+		return value
+
+	# opcodes are read like any other byte; StatsBgmReader counts them.
+	# read_cmd is used outside detours followed byte by byte
+	next_cmd = next_byte
+	read_cmd = u8
+
+	def step_detour( self, count: int ) -> None:
+		if self.detour_remain > 0:
+			self.detour_remain -= count
+			if self.detour_remain <= 0:
+				self.pos, self.detour_remain = self.ret_stack.pop()
+
+	def detour( self, target: int, length: int ) -> None:
+		self.ret_stack.append( ( self.pos, self.detour_remain ) )
+		self.pos = target
+		self.detour_remain = length
+
+	# Move to a detour phrase parsed as a whole, returning the state for leave_phrase
+	def enter_phrase( self, target: int ) -> tuple:
+		state = ( self.pos, self.detour_remain )
+		self.pos = target
+		# the phrase's bytes don't count against a detour followed byte by byte
+		self.detour_remain = 0
+		return state
+
+	def leave_phrase( self, state: tuple ) -> None:
+		self.pos, self.detour_remain = state
+
+	# called for every detour, however it is parsed; StatsBgmReader counts them
+	def count_detour( self ) -> None:
+		pass
 
 #-----------------------------------------------------------
 
-def handle_detour( f: BinaryIO, track: ParserTrack ) -> None:
-	if track.detour_remain > 0:
-		track.detour_remain -= 1
-		if track.detour_remain == 0:
-			f.seek( track.ret_pos )
+# Timings and counters for --stats. A phase entered from another only
+# counts towards the inner one
+class ConvertStats:
+	PHASES = ( 'header', 'parse', 'sort', 'ramps', 'optimize', 'midi_build', 'save' )
+
+	def __init__( self ):
+		self.times			= dict.fromkeys( self.PHASES, 0.0 )
+		self.opcodes		= [0] * 256
+		self.detours		= 0
+		self.bytes_read		= 0
+		self.events			= [0] * len( EventTypes )
+		self.peak_memory	= None
+		self.cache_hit		= False
+		self.stack			: List[str] = []
+		self.mark			= 0.0
+
+	def enter( self, phase: str ) -> None:
+		now = time.perf_counter()
+		if self.stack:
+			self.times[self.stack[-1]] += now - self.mark
+		self.stack.append( phase )
+		self.mark = now
+
+	def leave( self ) -> None:
+		now = time.perf_counter()
+		self.times[self.stack.pop()] += now - self.mark
+		self.mark = now
+
+	# Wrap the iterator `it`, counting the time spent producing each item towards `phase`
+	def timed( self, phase: str, it ):
+		while True:
+			self.enter( phase )
+			try:
+				value = next( it )
+			except StopIteration:
+				return
+			finally:
+				self.leave()
+			yield value
+
+	# Wrap `func`, counting the time spent in it towards `phase`
+	def timed_call( self, phase: str, func ):
+		def wrapper( *args ):
+			self.enter( phase )
+			try:
+				return func( *args )
+			finally:
+				self.leave()
+		return wrapper
+
+	def counters( self ) -> tuple:
+		return ( self.opcodes, self.detours, self.bytes_read )
+
+	def add_counters( self, counters: tuple ) -> None:
+		# add the counters of a track parsed in a worker process
+		opcodes, detours, bytes_read = counters
+
+		for cmd, count in enumerate( opcodes ):
+			self.opcodes[cmd] += count
+
+		self.detours += detours
+		self.bytes_read += bytes_read
+
+	def count_events( self, rows ):
+		events = self.events
+		for row in rows:
+			events[row[1]] += 1
+			yield row
+
+	def to_dict( self ) -> dict:
+		opcodes = {}
+
+		for cmd, count in enumerate( self.opcodes ):
+			if count != 0:
+				opcodes['{:02X}'.format( cmd )] = count
+
+		return {
+			'cache_hit'		: self.cache_hit,
+			'times'			: dict( self.times ),
+			'opcodes'		: opcodes,
+			'detours'		: self.detours,
+			'bytes_read'	: self.bytes_read,
+			'events'		: { event_type.name: self.events[event_type] for event_type in EventTypes },
+			'peak_memory'	: self.peak_memory,
+		}
+
+	def report( self ) -> None:
+		if self.cache_hit:
+			print( 'Served from cache; nothing was converted' )
+			return
+
+		print( 'Phase times (ms):' )
+		for phase in self.PHASES:
+			print( '  {:12s} {:10.2f}'.format( phase, self.times[phase] * 1000 ) )
+
+		print( 'Opcodes:' )
+		print( '  {:24s} {:8d}'.format( 'delta time', sum( self.opcodes[0x01:0x80] ) ) )
+		print( '  {:24s} {:8d}'.format( 'note', sum( self.opcodes[0x80:0xd4] ) ) )
+		for cmd in range( 0xd4, 0x100 ):
+			if self.opcodes[cmd] != 0:
+				print( '  {:02X} {:21s} {:8d}{}'.format( cmd, cmd_names.get( cmd, 'undefined' ), self.opcodes[cmd],
+					' (ignored)' if cmd in ignored_cmds or cmd not in cmd_names else '' ) )
+		print( '  {:24s} {:8d}'.format( 'end of track', self.opcodes[0] ) )
+
+		print( 'Detours followed: {:d}'.format( self.detours ) )
+		print( 'Bytes read: {:d}'.format( self.bytes_read ) )
+
+		print( 'Events:' )
+		for event_type in EventTypes:
+			print( '  {:24s} {:8d}'.format( event_type.name, self.events[event_type] ) )
+
+		if self.peak_memory is not None:
+			print( 'Peak memory: {:.1f} KiB'.format( self.peak_memory / 1024 ) )
 
 #-----------------------------------------------------------
 
-def handle_tempo_fades( f: BinaryIO, parser: Parser, track_num: int ) -> None:
-	track = parser.tracks[track_num]
-	tempo = 156
+# BgmReader that counts opcodes, detours and bytes read into a ConvertStats
+class StatsBgmReader( BgmReader ):
+	def __init__( self, data, stats: ConvertStats ):
+		super().__init__( data )
+		self.stats = stats
 
-	# number of tempo events encountered+generated so far
-	occurrence = 0
+	def u8( self ) -> int:
+		self.stats.bytes_read += 1
+		return super().u8()
 
-	for event in track.events:
-		if event.type == EventTypes.TEMPO:
-			tempo = event.tempo
-			occurrence += 1
+	def read_int( self, width: int, signed: bool ) -> int:
+		self.stats.bytes_read += width
+		return super().read_int( width, signed )
 
-		if event.type == EventTypes.TEMPO_FADE:
-			next_tempo = None
+	def unpack( self, fmt: struct.Struct ) -> tuple:
+		self.stats.bytes_read += fmt.size
+		return super().unpack( fmt )
 
-			try:
-				next_tempo = [e[1] for e in enumerate( track.events ) if e[1].type == EventTypes.TEMPO][occurrence]
-			except IndexError:
-				pass
+	def next_cmd( self ) -> int:
+		cmd = self.next_byte()
+		self.stats.opcodes[cmd] += 1
+		return cmd
+
+	def read_cmd( self ) -> int:
+		cmd = self.u8()
+		self.stats.opcodes[cmd] += 1
+		return cmd
+
+	def count_detour( self ) -> None:
+		self.stats.detours += 1
+
+#-----------------------------------------------------------
+
+# ( tick, value ) pairs of a linear ramp, every `step` ticks, skipping
+# values within `min_delta` of the last one; the target always comes last
+def ramp_points( duration: int, start: float, target: float, step: int = 1, min_delta: float = 0 ):
+	last = start
+	step = max( step, 1 )
+
+	for tick in range( step, duration, step ):
+		value = start + ( target - start ) * tick / duration
+
+		if abs( value - last ) >= min_delta and value != last:
+			yield ( tick, value )
+			last = value
+
+	yield ( max( duration, 0 ), target )
+
+#-----------------------------------------------------------
+
+# Like ramp_points for whole numbers, solving directly for the first tick
+# where the rounded value has moved `threshold` on, rounded up to `step`
+def ramp_levels( duration: int, start: int, target: int, step: int = 1, threshold: int = 1 ):
+	step = max( step, 1 )
+	threshold = max( threshold, 1 )
+	distance = abs( target - start )
+	sign = 1 if target > start else -1
+	last = None
+
+	if duration > 0:
+		for n in range( threshold, distance + 1, threshold ):
+			# the value rounds to start + sign * n from halfway between the two levels on
+			tick = -( -duration * ( 2 * n - 1 ) // ( 2 * distance ) )
+			tick = -( -tick // step ) * step
+
+			if tick >= duration:
+				break
+
+			# of several levels reached on the same tick only the last is kept
+			if last is not None and last[0] != tick:
+				yield last
+
+			last = ( tick, start + sign * n )
+
+	if last is not None:
+		yield last
+
+	if last is None or last[1] != target:
+		yield ( max( duration, 0 ), target )
+
+#-----------------------------------------------------------
+
+# Tempo, master volume or subvolume as stream_ramps fades it. A fade is cut
+# short by the next event setting the value; `next_row` is the next row due
+class Ramp:
+	def __init__( self, value: float, make_rows ):
+		self.value		= value
+		# called with the fade's row, start value, fade time and target
+		self.make_rows	= make_rows
+		self.fade		= None
+		self.rows		= iter( () )
+		self.next_row	= None
+
+	def stop( self, time: int ) -> None:
+		if self.fade is not None:
+			start_time, fade_time, target = self.fade
+
+			if time < start_time + fade_time:
+				self.value = self.value + ( target - self.value ) * ( time - start_time ) / fade_time
+			else:
+				self.value = target
+
+			self.fade = None
+			self.rows = iter( () )
+			self.next_row = None
+
+	def set( self, time: int, value: float ) -> None:
+		self.stop( time )
+		self.value = value
+
+	def start( self, row: tuple, fade_time: int, target: float ) -> None:
+		self.stop( row[0] )
+		self.fade = ( row[0], fade_time, target )
+		self.rows = self.make_rows( row, self.value, fade_time, target )
+		self.next_row = next( self.rows )
+
+# Expand tempo, master volume and subvolume fades in one track's rows into
+# TEMPO, sysex and CC 11 events, and with options.tremolo, tremolo into CC 1.
+# Fields after the fifth are passed on to the events generated from a row
+def stream_ramps( rows, options: 'ConvertOptions' ):
+	step = options.ramp_step
+	threshold = options.ramp_threshold
+
+	def tempo_rows( row, value, fade_time, target ):
+		return ( ( row[0] + tick, EventTypes.TEMPO, row[2], bpm_to_tempo( bpm ), 0, *row[5:] )
+			for tick, bpm in ramp_points( fade_time, value, target, options.tempo_fade_step, options.tempo_fade_bpm ) )
+
+	def master_volume_rows( row, value, fade_time, target ):
+		return ( ( row[0] + tick, EventTypes.SYSEX, row[2], MASTER_VOLUME_SYSEX + ( volume, ), 0, *row[5:] )
+			for tick, volume in ramp_levels( fade_time, int( value + 0.5 ), target, step, threshold ) )
+
+	def subvolume_rows( row, value, fade_time, target ):
+		return ( ( row[0] + tick, EventTypes.CC, row[2], 11, volume, *row[5:] )
+			for tick, volume in ramp_levels( fade_time, int( value + 0.5 ), target, step, threshold ) )
+
+	tempo = Ramp( 156, tempo_rows )
+	master_volume = Ramp( 127, master_volume_rows )
+	subvolume = Ramp( 127, subvolume_rows )
+	# modulation set after the tremolo delay of the last note; its fade is the
+	# depth it rises to
+	modulation = Ramp( 0, None )
+	fade_ramps = {
+		EventTypes.TEMPO_FADE			: tempo,
+		EventTypes.MASTER_VOLUME_FADE	: master_volume,
+		EventTypes.SUBVOLUME_FADE		: subvolume,
+	}
+
+	# points of different ramps on the same tick are yielded in this order
+	ramps = ( tempo, master_volume, subvolume, modulation )
+	# the time of the first point left to yield
+	next_due = None
+
+	tremolo_delay = 0
+	tremolo_depth = 0
+
+	# the events that start, stop or set a ramp; the rest pass straight through
+	ramp_events = { EventTypes.TEMPO, EventTypes.CC, EventTypes.SYSEX, EventTypes.TREMOLO, *fade_ramps }
+
+	if options.tremolo:
+		ramp_events.add( EventTypes.NOTE_ON )
+
+	def schedule( ramp: Ramp ) -> None:
+		nonlocal next_due
+
+		if next_due is None or ramp.next_row[0] < next_due:
+			next_due = ramp.next_row[0]
+
+	for row in rows:
+		time = row[0]
+		event_type = row[1]
+
+		if next_due is not None and next_due < time:
+			due = []
+			next_due = None
+
+			for ramp in ramps:
+				pending = ramp.next_row
+
+				while pending is not None and pending[0] < time:
+					due.append( pending )
+					pending = next( ramp.rows, None )
+
+				ramp.next_row = pending
+
+				if pending is not None and ( next_due is None or pending[0] < next_due ):
+					next_due = pending[0]
+
+			if len( due ) > 1:
+				due.sort( key = lambda point: point[0] )
+
+			yield from due
+
+		if event_type not in ramp_events:
+			pass
+		elif event_type == EventTypes.NOTE_ON:
+			depth = tremolo_depth if tremolo_delay == 0 else 0
+
+			if modulation.fade is not None:
+				# the previous note's rise to the tremolo depth only happened if it was yielded
+				if modulation.next_row is None:
+					modulation.value = modulation.fade
+
+				modulation.fade = None
+				modulation.next_row = None
+
+			if modulation.value != depth:
+				modulation.value = depth
+				yield ( time, EventTypes.CC, row[2], 1, depth, *row[5:] )
+
+			if depth != tremolo_depth:
+				modulation.fade = tremolo_depth
+				modulation.next_row = ( time + tremolo_delay, EventTypes.CC, row[2], 1, tremolo_depth, *row[5:] )
+				schedule( modulation )
+		elif event_type in fade_ramps:
+			ramp = fade_ramps[event_type]
+			ramp.start( row, row[3], row[4] )
+			schedule( ramp )
+			continue
+		elif event_type == EventTypes.TEMPO:
+			tempo.set( time, tempo_to_bpm( row[3] ) )
+		elif event_type == EventTypes.CC:
+			if row[3] == 11:
+				subvolume.set( time, row[4] )
+		elif event_type == EventTypes.SYSEX:
+			if row[3][:3] == MASTER_VOLUME_SYSEX:
+				master_volume.set( time, row[3][3] )
+		elif event_type == EventTypes.TREMOLO:
+			tremolo_delay = row[3]
+			tremolo_depth = row[4]
+			continue
+
+		yield row
+
+	due = [row for ramp in ramps if ramp.next_row is not None for row in ( ramp.next_row, *ramp.rows )]
+	due.sort( key = lambda point: point[0] )
+	yield from due
+
+#-----------------------------------------------------------
+
+# Drop events that repeat the channel's current value or are overridden on
+# the same tick before a note plays, counting them in `removed` by type
+def optimize_rows( rows, removed: List[int] ):
+	state = {}
+	tick = None
+	group = []
+	# index in `group` of the last setting of each kind since the last note
+	latest = {}
+
+	def flush():
+		for row in group:
+			if row is None:
+				continue
+
+			event_type = row[1]
+
+			if event_type == EventTypes.CC:
+				key, value = ( EventTypes.CC, row[3] ), row[4]
+			elif event_type == EventTypes.WHEEL:
+				key, value = EventTypes.WHEEL, row[3]
+			elif event_type == EventTypes.PROGRAM:
+				key, value = EventTypes.PROGRAM, ( row[3], row[4] )
+			else:
+				# the tempo is shared with the other tracks, which may change it
+				# in between, so tempo changes are only ever dropped when overridden
+				if ( event_type == EventTypes.SYSEX and row[3][:3] != MASTER_VOLUME_SYSEX ) or \
+					( event_type == EventTypes.MARKER and row[3] == 'loopStart' ):
+					state.clear()
+				yield row
+				continue
+
+			if state.get( key ) == value:
+				removed[event_type] += 1
+				continue
+
+			state[key] = value
+			yield row
+
+	for row in rows:
+		if row[0] != tick:
+			yield from flush()
+			tick = row[0]
+			group = []
+			latest.clear()
+
+		event_type = row[1]
+
+		if event_type == EventTypes.CC:
+			key = ( EventTypes.CC, row[3] )
+		elif event_type == EventTypes.WHEEL or event_type == EventTypes.PROGRAM or event_type == EventTypes.TEMPO:
+			key = event_type
+		else:
+			if event_type != EventTypes.TEMPO_FADE:
+				latest.clear()
+			group.append( row )
+			continue
+
+		index = latest.get( key )
+
+		if index is not None:
+			group[index] = None
+			removed[event_type] += 1
+
+		latest[key] = len( group )
+		group.append( row )
+
+	yield from flush()
+
+#-----------------------------------------------------------
+
+# Mark a jump back to `loop_time` with loopStart/loopEnd, copying the body
+# first with --unroll
+def handle_loop( parser: Parser, track: ParserTrack, offset: int, loop_time: int, loop_index: int ) -> None:
+	options = parser.options
+	length = track.time_at - loop_time
+
+	# rebuild the body so the loop start marker precedes the events at its tick
+	body = track.events.extract( loop_index, loop_time )
+	track.events.truncate( loop_index )
+	track.time_at = loop_time
+
+	if length > 0:
+		for i in range( options.unroll - 1 ):
+			track.events.extend( body, track.time_at )
+			track.time_at += length
+
+	track.events.append_marker( offset, track.time_at, 'loopStart' )
+
+	if options.loop_cc111:
+		track.events.append( EventTypes.CC, offset, track.time_at, 111, 0 )
+
+	track.events.extend( body, track.time_at )
+	track.time_at += length
+
+	track.events.append_marker( offset, track.time_at, 'loopEnd' )
+
+#-----------------------------------------------------------
+
+# command handlers, called with the command's decoded operands. A handler
+# returns True when the track ends at the command.
+
+def cmd_tempo( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, bpm: int ):
+	track.events.append( EventTypes.TEMPO, offset, track.time_at, bpm_to_tempo( bpm ) )
+
+def cmd_tempo_fade( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict,
+	duration: int, bpm: int ):
+	track.events.append( EventTypes.TEMPO_FADE, offset, track.time_at, duration, bpm )
+
+def cmd_master_volume( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, value: int ):
+	track.events.append_sysex( offset, track.time_at, MASTER_VOLUME_SYSEX + ( min( value, 127 ), ) )
+
+def cmd_master_volume_fade( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict,
+	duration: int, value: int ):
+	track.events.append( EventTypes.MASTER_VOLUME_FADE, offset, track.time_at, duration, min( value, 127 ) )
+
+def cmd_patch_override( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict,
+	bank: int, patch: int ):
+	if not track.drum_active:
+		track.patch_bank = bank
+		track.events.append( EventTypes.PROGRAM, offset, track.time_at, bank, min( patch, 127 ) )
+
+def cmd_subvolume( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, value: int ):
+	track.events.append( EventTypes.CC, offset, track.time_at, 11, value )
+
+def cmd_subvolume_fade( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict,
+	duration: int, value: int ):
+	track.events.append( EventTypes.SUBVOLUME_FADE, offset, track.time_at, duration, min( value, 127 ) )
+
+def cmd_pan( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, value: int ):
+	track.events.append( EventTypes.CC, offset, track.time_at, 10, value )
+
+def cmd_reverb( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, value: int ):
+	track.events.append( EventTypes.CC, offset, track.time_at, 91, value )
+
+def cmd_volume( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, value: int ):
+	track.events.append( EventTypes.CC, offset, track.time_at,  7, value )
+
+def append_wheel( track: ParserTrack, offset: int ) -> None:
+	track.events.append( EventTypes.WHEEL, offset, track.time_at,
+		int( track.coarse_tune + track.fine_tune + track.tuning ) )
+
+def cmd_coarse_tune( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, value: int ):
+	track.coarse_tune = PITCH_STEP_COARSE * value
+	append_wheel( track, offset )
+
+def cmd_fine_tune( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, value: int ):
+	track.coarse_tune = PITCH_STEP_FINE * value
+	append_wheel( track, offset )
+
+def cmd_tuning( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, value: int ):
+	track.tuning = value / 100 * PITCH_STEP_COARSE
+	append_wheel( track, offset )
 
-			time = event.time
-			fade_time = 1 if event.fade_time <= 0 else event.fade_time
-			step = int( ( event.target - tempo ) / fade_time )
-
-			if next_tempo == None:
-				for i in range( event.fade_time ):
-					track.events.append( ParserEvent( EventTypes.TEMPO, event.offset, time + i, tempo + ( step * i ) ) )
-					occurrence += 1
-					
-				track.events.append( ParserEvent( EventTypes.TEMPO, event.offset, time + event.fade_time, event.target ) )
-				occurrence += 1
+def cmd_tremolo( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict,
+	delay: int, speed: int, depth: int ):
+	track.events.append( EventTypes.TREMOLO, offset, track.time_at, delay, min( depth, 127 ) )
+
+def cmd_tremolo_stop( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict ):
+	track.events.append( EventTypes.TREMOLO, offset, track.time_at, 0, 0 )
+
+def cmd_patch_set( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict, index: int ):
+	bank_patch = parser.patch_ex_map[index]
+	track.events.append( EventTypes.PROGRAM, offset, track.time_at, bank_patch[0], min( bank_patch[1], 127 ) )
+
+def cmd_jump( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict,
+	table: int, count: int ):
+	# table points to count entries ( target offset, flags ), one per song
+	# variation; the default variation uses the first one
+	return_pos = reader.tell()
+	reader.seek( table )
+	target = reader.u16()
+	reader.seek( return_pos )
+
+	if target in visited:
+		handle_loop( parser, track, offset, *visited[target] )
+		return True
+
+	reader.reset_detour()
+	reader.seek( target )
+
+def cmd_detour( reader: BgmReader, parser: Parser, track: ParserTrack, offset: int, visited: dict,
+	target: int, length: int ):
+	reader.count_detour()
+	phrase = scan_phrase( reader, parser, target, length )
+
+	if phrase is None:
+		reader.detour( target, length )
+		return
+
+	# a phrase is parsed once for each state it starts in, counting only the
+	# parts of the track state its commands use, and its events are spliced
+	# in wherever it is played again in that state
+	end, cmds = phrase
+	is_drum = track.drum_active
+	state = track.get_state()
+	tunes = not TUNING_CMDS.isdisjoint( cmds )
+	drum_notes = is_drum and 0x80 in cmds
+	key = ( target, length, is_drum, state[:3] if tunes else None, state[5] if drum_notes else None )
+	cached = parser.detour_cache.get( key )
+
+	if cached is not None:
+		fragment, duration, end_state = cached
+		track.events.extend( fragment, track.time_at )
+		track.time_at += duration
+
+		# the parts of the state the phrase sets, as in ParserTrack.get_state
+		sets = ( 0xed in cmds or 0xee in cmds, False, 0xef in cmds, False, 0xe8 in cmds and not is_drum, drum_notes )
+		track.set_state( tuple( new if set_by_phrase else old
+			for new, old, set_by_phrase in zip( end_state, state, sets ) ) )
+		return
+
+	start = len( track.events )
+	start_time = track.time_at
+
+	reader_state = reader.enter_phrase( target )
+	parse_commands( reader, parser, track, visited, end )
+	reader.leave_phrase( reader_state )
+
+	parser.detour_cache[key] = (
+		track.events.extract( start, start_time ), track.time_at - start_time, track.get_state() )
+
+# commands setting part of the tuning, all of which every pitch bend written adds up
+TUNING_CMDS = frozenset( ( 0xed, 0xee, 0xef ) )
+
+# ( end, cmds ) of the detour phrase at `target`, with 0x80 in cmds standing
+# for notes, or None if it must be followed byte by byte, such as when it
+# ends part way through a command
+def scan_phrase( reader: BgmReader, parser: Parser, target: int, length: int ):
+	key = ( target, length )
+
+	if key in parser.phrases:
+		return parser.phrases[key]
+
+	# a phrase detouring into itself is followed byte by byte
+	parser.phrases[key] = None
+
+	data = reader.data
+	size = reader.size
+	pos = target
+	remain = length
+	cmds = set()
+	phrase = None
+
+	while remain > 0 and pos < size:
+		cmd = data[pos]
+
+		if cmd == 0 or cmd == 0xfc:
+			break
+		elif cmd < 0x80:
+			cmd_size = 2 if cmd >= 0x78 else 1
+		elif cmd < 0xd4:
+			if pos + 2 >= size:
+				break
+			cmd_size = 4 if data[pos + 2] >= 0xc0 else 3
+			cmds.add( 0x80 )
+		elif cmd < 0xe0:
+			cmd_size = 1
+		else:
+			cmd_size = 1 + cmd_len_table[cmd - 0xe0]
+			cmds.add( cmd )
+
+		if pos + cmd_size > size:
+			break
+
+		if cmd < 0xd4:
+			# delta times and notes are counted byte by byte
+			if remain < cmd_size:
+				break
+			remain -= cmd_size
+		else:
+			# the operands of other commands are read before they are counted,
+			# except those of a detour, which aren't counted at all
+			if remain == 1 and cmd_size > 1:
+				break
+			elif cmd == 0xfe:
+				nested = scan_phrase( reader, parser, *struct.unpack_from( '>HB', data, pos + 1 ) )
+				if nested is None:
+					break
+				cmds.update( nested[1] )
+				remain -= 1
 			else:
-				num_events = next_tempo.time - event.time
+				remain -= cmd_size
+
+		pos += cmd_size
 
-				for i in range( num_events ):
-					track.events.append( ParserEvent( EventTypes.TEMPO, event.offset, time + i, tempo - ( step * i ) ) )
-					occurrence += 1
+		if remain <= 0:
+			phrase = ( pos, frozenset( cmds ) )
+
+	parser.phrases[key] = phrase
+	return phrase
 
 #-----------------------------------------------------------
 
-def parse_subseg_track( f: BinaryIO, track: ParserTrack, is_drum: bool ) -> None:
-	offset = f.tell()
+# name, operand format and handler of every command from 0xE0 up. Commands
+# without a handler are decoded and skipped.
+cmd_specs = [
+	( 'tempo',					'H',	cmd_tempo ),			# E0
+	( 'master volume',			'B',	cmd_master_volume ),	# E1
+	( 'master tuning',			'B',	None ),					# E2
+	( 'unknown',				'B',	None ),					# E3
+	( 'tempo fade',				'HH',	cmd_tempo_fade ),		# E4
+	( 'master volume fade',		'HB',	cmd_master_volume_fade ),	# E5
+	( 'master effect',			'BB',	None ),					# E6
+	( 'undefined',				'',		None ),					# E7
+	( 'patch+bank override',	'BB',	cmd_patch_override ),	# E8
+	( 'subvolume',				'B',	cmd_subvolume ),		# E9
+	( 'pan',					'B',	cmd_pan ),				# EA
+	( 'reverb',					'B',	cmd_reverb ),			# EB
+	( 'volume',					'B',	cmd_volume ),			# EC
+	( 'coarse subtuning',		'b',	cmd_coarse_tune ),		# ED
+	( 'fine subtuning',			'b',	cmd_fine_tune ),		# EE
+	( 'tuning',					'h',	cmd_tuning ),			# EF
+	( 'tremolo',				'BBB',	cmd_tremolo ),			# F0
+	( 'tremolo speed',			'B',	None ),					# F1
+	( 'tremolo time',			'B',	None ),					# F2
+	( 'tremolo stop',			'',		cmd_tremolo_stop ),		# F3
+	( 'unknown',				'BB',	None ),					# F4
+	( 'patch set',				'B',	cmd_patch_set ),		# F5
+	( 'subvolume fade',			'HB',	cmd_subvolume_fade ),	# F6
+	( 'reverb type',			'B',	None ),					# F7
+	( 'undefined',				'',		None ),					# F8
+	( 'undefined',				'',		None ),					# F9
+	( 'undefined',				'',		None ),					# FA
+	( 'undefined',				'',		None ),					# FB
+	( 'jump',					'HB',	cmd_jump ),				# FC
+	( 'event trigger',			'BH',	None ),					# FD
+	( 'detour',					'HB',	cmd_detour ),			# FE
+	( 'unknown',				'BBB',	None ),					# FF
+]
+
+cmd_names = { 0xe0 + i: name for i, ( name, fmt, handler ) in enumerate( cmd_specs ) }
+
+# commands that are decoded but not translated to MIDI yet
+ignored_cmds = { 0xe0 + i for i, ( name, fmt, handler ) in enumerate( cmd_specs ) if handler is None }
 
-	cmd = read_int( f, 1, False )
-	handle_detour( f, track )
+cmd_len_table = [struct.calcsize( '>' + fmt ) for name, fmt, handler in cmd_specs]
 
+# ( operand struct, detour count, handler ) by command byte, from 0xD4 up
+def build_cmd_dispatch() -> list:
+	dispatch = [None] * 0xd4 + [( None, 0, None )] * 12
+
+	for name, fmt, handler in cmd_specs:
+		operands = struct.Struct( '>' + fmt ) if fmt else None
+		# operands of a detour don't count against the enclosing detour
+		count = 0 if handler is cmd_detour else struct.calcsize( '>' + fmt )
+		dispatch.append( ( operands, count, handler ) )
+
+	return dispatch
+
+cmd_dispatch = build_cmd_dispatch()
+
+#-----------------------------------------------------------
+
+def parse_subseg_track( reader: BgmReader, parser: Parser, track: ParserTrack, is_drum: bool ) -> None:
 	# handle sysex for normal/drum mode
 	if is_drum != track.drum_active:
 		track.drum_active = is_drum
 
 		if is_drum:
 			# set Part Mode to Drum1
-			track.events.append( ParserEvent( 
-				EventTypes.SYSEX, 0, track.time_at, ( 0x40, 0x10 | track.channel + 1, 0x15, 0x01 ) ) )
+			track.events.append_sysex( 0, track.time_at, ( 0x40, 0x10 | track.channel + 1, 0x15, 0x01 ) )
 		else:
 			# set Part Mode to Norm
-			track.events.append( ParserEvent( 
-				EventTypes.SYSEX, 0, track.time_at, ( 0x40, 0x10 | track.channel + 1, 0x15, 0x00 ) ) )
+			track.events.append_sysex( 0, track.time_at, ( 0x40, 0x10 | track.channel + 1, 0x15, 0x00 ) )
+
+	# time and first event row of each command outside detours, so that jumps
+	# back into the track can be recognised as loops
+	visited = { reader.tell(): ( track.time_at, len( track.events ) ) }
+
+	parse_commands( reader, parser, track, visited )
+
+# Parse commands until the track ends, returning True, or with `end`, until
+# the detour phrase ending there has been parsed
+def parse_commands( reader: BgmReader, parser: Parser, track: ParserTrack, visited: dict, end: int = None ) -> bool:
+	is_drum = track.drum_active
+	drum_table = parser.drum_table
+	events = track.events
+	offset = reader.tell()
+
+	while end is None or offset < end:
+		if reader.detour_remain > 0:
+			cmd = reader.next_cmd()
+			next_byte = reader.next_byte
+		else:
+			cmd = reader.read_cmd()
+			next_byte = reader.u8
 
-	# parse commands
-	while cmd != 0:
+		if cmd == 0:
+			return True
 		# delta time
-		if cmd < 0x80:
+		elif cmd < 0x80:
 			# long delta time
 			if cmd >= 0x78:
-				b2 = read_int( f, 1, False )
-				handle_detour( f, track )
+				b2 = next_byte()
 				track.time_at += ( ( cmd & 7 ) << 8 ) + b2 + 0x78
 			# short delta time
 			else:
@@ -367,182 +1317,61 @@ def parse_subseg_track( f: BinaryIO, track: ParserTrack, is_drum: bool ) -> None
 		# note event
 		elif cmd < 0xd4:
 			note   = cmd & 0x7f
-			vel    = read_int( f, 1, False )
-			handle_detour( f, track )
-			length = read_int( f, 1, False )
-			handle_detour( f, track )
+			vel    = next_byte()
+			length = next_byte()
 
 			# long length
 			if length >= 0xc0:
-				b2 = read_int( f, 1, False )
-				handle_detour( f, track )
+				b2 = next_byte()
 				length = ( ( length & ~0xc0 ) << 8 ) + b2 + 0xc0
 
 			if is_drum:
-				try:
-					params = drum_map[note]
-				except KeyError:
-					sys.exit( 'Drum {:d} is not in translation map'.format( note ) )
+				params = drum_table[note]
+
+				if params is None:
+					raise BgmFormatError( 'Drum {:d} is not in translation map'.format( note ) )
 
 				if track.patch != params[1]:
 					track.patch = params[1]
-					track.events.append( ParserEvent(
-						EventTypes.PROGRAM, offset, track.time_at, 0, track.patch ) )
+					events.append( EventTypes.PROGRAM, offset, track.time_at, 0, track.patch )
 				note = params[0]
 
-			track.events.append( ParserEvent(
-				EventTypes.NOTE_ON, offset, track.time_at, note, vel ) )
-			track.events.append( ParserEvent(
-				EventTypes.NOTE_OFF, offset, track.time_at + length, note, vel ) )
-		# tempo
-		elif cmd == 0xe0:
-			param1 = read_int( f, 2, False )
-			track.events.append( ParserEvent(
-				EventTypes.TEMPO, offset, track.time_at, param1 ) )
-		# master volume
-		elif cmd == 0xe1:
-			param1 = read_int( f, 1, False )
-			# TODO: implement
-		# master tuning
-		elif cmd == 0xe2:
-			param1 = read_int( f, 1, False )
-			# TODO: implement
-		# unknown
-		elif cmd == 0xe3:
-			param1 = read_int( f, 1, False )
-			# TODO: implement
-		# tempo fade
-		elif cmd == 0xe4:
-			param1 = read_int( f, 2, False )
-			param2 = read_int( f, 2, False )
-			track.events.append( ParserEvent(
-				EventTypes.TEMPO_FADE, offset, track.time_at, param1, param2 ) )
-			# TODO: implement
-		# master volume fade
-		elif cmd == 0xe5:
-			param1 = read_int( f, 2, False )
-			param2 = read_int( f, 1, False )
-			# TODO: implement
-		# master effect
-		elif cmd == 0xe6:
-			param1 = read_int( f, 1, False )
-			param2 = read_int( f, 1, False )
-			# TODO: implement
-		# track patch+bank override
-		elif cmd == 0xe8:
-			if not is_drum:
-				param1 = read_int( f, 1, False )
-				param2 = read_int( f, 1, False )
-				track.patch_bank = param1
-				track.events.append( ParserEvent(
-					EventTypes.PROGRAM, offset, track.time_at, param1, param2 ) )
-		# track subvolume
-		elif cmd == 0xe9:
-			param1 = read_int( f, 1, False )
-			track.events.append( ParserEvent( EventTypes.CC, offset, track.time_at, 11, param1 ) )
-		# track pan
-		elif cmd == 0xea:
-			param1 = read_int( f, 1, False )
-			track.events.append( ParserEvent( EventTypes.CC, offset, track.time_at, 10, param1 ) )
-		# track reverb
-		elif cmd == 0xeb:
-			param1 = read_int( f, 1, False )
-			track.events.append( ParserEvent( EventTypes.CC, offset, track.time_at, 91, param1 ) )
-		# track volume
-		elif cmd == 0xec:
-			param1 = read_int( f, 1, False )
-			track.events.append( ParserEvent( EventTypes.CC, offset, track.time_at,  7, param1 ) )
-		# track coarse subtuning
-		elif cmd == 0xed:
-			track.coarse_tune = PITCH_STEP_COARSE * read_int( f, 1, True )
-			track.events.append( ParserEvent(
-				EventTypes.WHEEL, offset, track.time_at,
-				track.coarse_tune + track.fine_tune + track.tuning ) )
-		# track fine subtuning
-		elif cmd == 0xee:
-			track.coarse_tune = PITCH_STEP_FINE * read_int( f, 1, True )
-			track.events.append( ParserEvent(
-				EventTypes.WHEEL, offset, track.time_at,
-				track.coarse_tune + track.fine_tune + track.tuning ) )
-		# track tuning
-		elif cmd == 0xef:
-			param1 = read_int( f, 2, True )
-			track.tuning = param1 / 100 * PITCH_STEP_COARSE
-			track.events.append( ParserEvent(
-				EventTypes.WHEEL, offset, track.time_at,
-				track.coarse_tune + track.fine_tune + track.tuning ) )
-		# track tremolo
-		elif cmd == 0xf0:
-			param1 = read_int( f, 1, False )
-			param2 = read_int( f, 1, False )
-			param3 = read_int( f, 1, False )
-			# TODO: implement
-		# track tremolo speed
-		elif cmd == 0xf1:
-			param1 = read_int( f, 1, False )
-			# TODO: implement
-		# track tremolo time
-		elif cmd == 0xf2:
-			param1 = read_int( f, 1, False )
-			# TODO: implement
-		# unknown
-		elif cmd == 0xf4:
-			param1 = read_int( f, 1, False )
-			param2 = read_int( f, 1, False )
-			# TODO: implement
-		# track patch set
-		elif cmd == 0xf5:
-			param1 = read_int( f, 1, False )
-
-			bank_patch = patch_ex_map[param1]
-			track.events.append( ParserEvent(
-				EventTypes.PROGRAM, offset, track.time_at, bank_patch[0], bank_patch[1] ) )
-		# track subvolume fade
-		elif cmd == 0xf6:
-			param1 = read_int( f, 2, False )
-			param2 = read_int( f, 1, False )
-			# TODO: implement
-		# track reverb type
-		elif cmd == 0xf7:
-			param1 = read_int( f, 1, False )
-			# TODO: implement
-		# jump
-		elif cmd == 0xfc:
-			param1 = read_int( f, 2, False )
-			param2 = read_int( f, 1, False )
-			# TODO: implement
-		# event trigger
-		elif cmd == 0xfd:
-			param1 = read_int( f, 4, False )
-			# TODO: implement
-		# detour
-		elif cmd == 0xfe:
-			param1 = read_int( f, 2, False )
-			param2 = read_int( f, 1, False )
-			track.ret_pos = f.tell()
-			f.seek( param1 )
-			track.detour_remain = param2
-		# unknown
-		elif cmd == 0xff:
-			param1 = read_int( f, 1, False )
-			param2 = read_int( f, 1, False )
-			param3 = read_int( f, 1, False )
-			# TODO: implement
-
-		if cmd >= 0xe0 and cmd != 0xfe:
-			for i in range( cmd_len_table[cmd - 0xe0] ):
-				handle_detour( f, track )
-
-		offset = f.tell()
-
-		cmd = read_int( f, 1, False )
-		handle_detour( f, track )
-
-#-----------------------------------------------------------
-
-def track2midi( track: ParserTrack, m_track = mido.MidiTrack ) -> None:
-	if len( track.events ) == 0:
-		return
+			vel = min( vel, 127 )
+
+			events.append( EventTypes.NOTE_ON, offset, track.time_at, note, vel )
+			events.append( EventTypes.NOTE_OFF, offset, track.time_at + length, note, vel )
+		# commands
+		else:
+			operands, count, handler = cmd_dispatch[cmd]
+
+			if operands is None:
+				args = ()
+			else:
+				args = reader.unpack( operands )
+
+			if handler is not None and handler( reader, parser, track, offset, visited, *args ):
+				return True
+
+			if reader.detour_remain > 0:
+				reader.step_detour( count )
+
+		offset = reader.tell()
+
+		if end is None and reader.detour_remain == 0:
+			visited[offset] = ( track.time_at, len( events ) )
+
+	return False
+
+#-----------------------------------------------------------
+
+# Append the MIDI messages for `rows`, or the track's event table, to m_track
+def track2midi( track: ParserTrack, m_track: 'mido.MidiTrack', rows = None ) -> None:
+	import_mido()
+
+	if rows is None:
+		if len( track.events ) == 0:
+			return
+		rows = track.events.rows()
 
 	delta_time = 0
 
@@ -560,173 +1389,2344 @@ def track2midi( track: ParserTrack, m_track = mido.MidiTrack ) -> None:
 
 	# convert sequence events to MIDI events
 
-	for e in track.events:
-		event_time = e.time - delta_time
+	for time, event_type, offset, param1, param2 in rows:
+		event_time = time - delta_time
 
-		if   e.type == EventTypes.NOTE_OFF:
+		if   event_type == EventTypes.NOTE_OFF:
 			m_track.append( mido.Message(
-				'note_off', channel = track.channel, note = e.note, velocity = e.velocity, time = event_time ) )
-		elif e.type == EventTypes.NOTE_ON:
+				'note_off', channel = track.channel, note = param1, velocity = param2, time = event_time ) )
+		elif event_type == EventTypes.NOTE_ON:
 			m_track.append( mido.Message(
-				'note_on', channel = track.channel, note = e.note, velocity = e.velocity, time = event_time ) )
-		elif e.type == EventTypes.CC:
+				'note_on', channel = track.channel, note = param1, velocity = param2, time = event_time ) )
+		elif event_type == EventTypes.CC:
 			m_track.append( mido.Message(
-				'control_change', channel = track.channel, control = e.control, value = e.value, time = event_time ) )
-		elif e.type == EventTypes.PROGRAM:
+				'control_change', channel = track.channel, control = param1, value = param2, time = event_time ) )
+		elif event_type == EventTypes.PROGRAM:
 			# bank select MSB
 			m_track.append( mido.Message(
-				'control_change', channel = track.channel, control = 0, value = e.value, time = event_time ) )
+				'control_change', channel = track.channel, control = 0, value = param1, time = event_time ) )
 
 			m_track.append( mido.Message(
-				'program_change', channel = track.channel, program = e.program, time = 0 ) )
-		elif e.type == EventTypes.WHEEL:
+				'program_change', channel = track.channel, program = param2, time = 0 ) )
+		elif event_type == EventTypes.WHEEL:
 			# clamp pitch bend range
-			if e.pitch > 8191 or e.pitch < -8192:
-				print( 'WARNING: pitch event at 0x{:04x} exceeds +/-24 semitones'.format( e.offset ) )
+			if param1 > 8191 or param1 < -8192:
+				warnings.warn( 'Pitch event at 0x{:04x} exceeds +/-24 semitones'.format( offset ), BgmWarning )
 
-			pitch = max( min( e.pitch, 8191 ), -8192 )
+			pitch = max( min( param1, 8191 ), -8192 )
 
 			m_track.append( mido.Message(
-				'pitchwheel', channel = track.channel, pitch = int( pitch ), time = event_time ) )
-		elif e.type == EventTypes.TEMPO:
+				'pitchwheel', channel = track.channel, pitch = pitch, time = event_time ) )
+		elif event_type == EventTypes.TEMPO:
 			m_track.append( mido.MetaMessage(
-				'set_tempo', tempo = mido.bpm2tempo( e.tempo ), time = event_time ) )
-		elif e.type == EventTypes.SYSEX:
-			checksum = 128 - ( sum( e.data ) % 128 )
-			data = ( 0x41, 0x10, 0x42, 0x12 ) + e.data + ( checksum, )
+				'set_tempo', tempo = param1, time = event_time ) )
+		elif event_type == EventTypes.SYSEX:
+			checksum = -sum( param1 ) & 0x7f
+			data = ( 0x41, 0x10, 0x42, 0x12 ) + param1 + ( checksum, )
 			
 			m_track.append( mido.Message( 
 				'sysex', data = data, time = event_time ) )
+		elif event_type == EventTypes.MARKER:
+			m_track.append( mido.MetaMessage(
+				'marker', text = param1, time = event_time ) )
+		else:
+			# TEMPO_FADE has been expanded already and produces nothing
+			continue
 
-		delta_time = e.time
+		delta_time = time
 
 #-----------------------------------------------------------
 
-def main():
-	args = argparse.ArgumentParser()
-	parser = Parser()
+# Return the IDs of the segments present in the BGMFileInfo
+def get_segments( reader: BgmReader ) -> List[int]:
+	segments = []
 
-	args.add_argument(
-		'-t', '--translate-drums', action = 'store_true',
-		help = 'translate drum mapping to GS drum mapping' )
-	args.add_argument(
-		'-i', '--in', dest = 'in_file',
-		help = 'BGM file name', required = True )
-	args.add_argument(
-		'-s', '--segment', dest = 'segment',
-		type = int, choices = range( 0, 4 ),
-		help = 'segment ID (0-3)', required = True )
-	args.add_argument(
-		'-o', '--out', dest = 'out_file',
-		help = 'MIDI file name', required = True )
+	reader.seek( 0x14 )
 
-	args = args.parse_args()
+	for i in range( 4 ):
+		if reader.u16() != 0:
+			segments.append( i )
 
-	bin_f = open( args.in_file, 'rb' )
-	mid_f = mido.MidiFile( type = 1 )
-	mid_f.ticks_per_beat = 48
+	return segments
 
-	# ------------------------------------------------
-	# read from BGMFileInfo
+#-----------------------------------------------------------
 
-	bin_f.seek( 0x14 + ( args.segment << 1 ) )
+def encode_vlq( value: int ) -> bytes:
+	out = [value & 0x7f]
+	value >>= 7
 
-	seg_ofs = read_int( bin_f, 2, False ) << 2
-	seg_pos = seg_ofs
+	while value:
+		out.append( 0x80 | ( value & 0x7f ) )
+		value >>= 7
 
-	bin_f.seek( 0x1c )
-	drums_ofs = read_int( bin_f, 2, False ) << 2
-	drums_cnt = read_int( bin_f, 2, False )
+	return bytes( reversed( out ) )
 
-	patch_ofs = read_int( bin_f, 2, False ) << 2
-	patch_cnt = read_int( bin_f, 2, False )
+#-----------------------------------------------------------
 
-	if seg_ofs == 0:
-		sys.exit( 'Requested segment does not exist' )
+# Roland DT1 message around `sysex`, from 0xF0 to 0xF7
+def roland_sysex( sysex: tuple ) -> bytes:
+	checksum = -sum( sysex ) & 0x7f
+	data = ( 0x41, 0x10, 0x42, 0x12 ) + sysex + ( checksum, )
 
-	# ------------------------------------------------
-	# load EX drum data
+	if max( data ) > 0x7f:
+		raise ValueError( 'data byte must be in range 0..127' )
 
-	bin_f.seek( drums_ofs )
+	return bytes( ( 0xf0, ) + data + ( 0xf7, ) )
 
-	for i in range( drums_cnt ):
-		# dummy read
-		read_int( bin_f, 1, False )
+# Roland DT1 message around `sysex` as an SMF sysex event, without the delta time
+def sysex_bytes( sysex: tuple ) -> bytes:
+	message = roland_sysex( sysex )
+	return message[:1] + encode_vlq( len( message ) - 1 ) + message[1:]
 
-		parser.add_drum( read_int( bin_f, 1, False ) )
-		
-		# dummy read
-		read_int( bin_f, 10, False )
+#-----------------------------------------------------------
 
-	# ------------------------------------------------
-	# load EX patch data
+SMF_PIECE_SIZE = 1 << 16
 
-	bin_f.seek( patch_ofs )
+# Encode rows as an MTrk chunk body, in pieces of about SMF_PIECE_SIZE
+# bytes, byte for byte as track2midi and mido would write it
+def track2smf( rows, channel: int ):
+	return encode_smf_track( zip( itertools.repeat( channel ), rows ), ( channel, ) )
 
-	for i in range( patch_cnt ):
-		bank	= read_int( bin_f, 1, False )
-		patch	= read_int( bin_f, 1, False )
-		patch_ex_map[i] = ( bank, patch )
+# track2smf for ( channel, row ) pairs of several channels, setting the
+# pitch bend range of each of `channels` first
+def encode_smf_track( items, channels ):
+	out = bytearray()
 
-		# dummy read
-		read_int( bin_f, 6, False )
+	# set pitch bend sensitivity to +/-24 semitones (RPN 0,0 data entry 24)
+	for channel in channels:
+		out += bytes( ( 0x00, 0xb0 | channel, 101, 0, 0x00, 100, 0, 0x00, 6, 24 ) )
 
-	# ------------------------------------------------
-	# begin track data parsing
+	running = 0xb0 | channels[-1] if channels else None
+	delta_time = 0
+	sysex_cache = {}
 
-	for i in range( 16 ):
-		parser.add_track()
+	for channel, ( time, event_type, offset, param1, param2 ) in items:
+		if event_type == EventTypes.TEMPO_FADE:
+			continue
 
-	while True:
-		for track in parser.tracks:
-			track.time_at = parser.tracks[0].time_at
+		if len( out ) >= SMF_PIECE_SIZE:
+			yield out
+			out = bytearray()
 
-		bin_f.seek( seg_pos )
-		seg_pos += 4
+		delta = time - delta_time
+		delta_time = time
 
-		seg_cmd = read_int( bin_f, 2, False )
+		if delta < 0x80:
+			out.append( delta )
+		else:
+			out += encode_vlq( delta )
 
-		if seg_cmd == 0:
-			break
+		if event_type == EventTypes.NOTE_OFF or event_type == EventTypes.NOTE_ON or event_type == EventTypes.CC:
+			if ( param1 | param2 ) & ~0x7f:
+				raise ValueError( 'data byte must be in range 0..127' )
 
-		sub_ofs = read_int( bin_f, 2, False ) << 2
+			status = ( 0x80 if event_type == EventTypes.NOTE_OFF else 0x90 if event_type == EventTypes.NOTE_ON else 0xb0 ) | channel
 
-		if sub_ofs == 0:
-			continue
-	
-		sub_ofs += seg_ofs
-		bin_f.seek( sub_ofs )
+			if status != running:
+				out.append( status )
+				running = status
 
-		for track in parser.tracks:
-			track_ofs = read_int( bin_f, 2, False )
+			out.append( param1 )
+			out.append( param2 )
+		elif event_type == EventTypes.PROGRAM:
+			if ( param1 | param2 ) & ~0x7f:
+				raise ValueError( 'data byte must be in range 0..127' )
 
-			track_flags = read_int( bin_f, 2, False )
-			is_drum = track_flags & 0x0080 != 0 and args.translate_drums == True	
+			# bank select MSB, then the program change at the same tick
+			if running != 0xb0 | channel:
+				out.append( 0xb0 | channel )
 
-			if track_ofs == 0:
-				continue
+			out += bytes( ( 0, param1, 0x00, 0xc0 | channel, param2 ) )
+			running = 0xc0 | channel
+		elif event_type == EventTypes.WHEEL:
+			# clamp pitch bend range
+			if param1 > 8191 or param1 < -8192:
+				warnings.warn( 'Pitch event at 0x{:04x} exceeds +/-24 semitones'.format( offset ), BgmWarning )
+
+			pitch = max( min( param1, 8191 ), -8192 ) + 8192
+
+			if running != 0xe0 | channel:
+				running = 0xe0 | channel
+				out.append( running )
 
-			track_ofs += sub_ofs
+			out.append( pitch & 0x7f )
+			out.append( pitch >> 7 )
+		elif event_type == EventTypes.TEMPO:
+			if not 0 <= param1 <= 0xffffff:
+				raise ValueError( 'tempo must be in range 0..16777215' )
 
-			next_track_pos = bin_f.tell()
-			bin_f.seek( track_ofs )
+			out += bytes( ( 0xff, 0x51, 0x03 ) ) + param1.to_bytes( 3, 'big' )
+			running = None
+		elif event_type == EventTypes.SYSEX:
+			if param1 not in sysex_cache:
+				sysex_cache[param1] = sysex_bytes( param1 )
 
-			parse_subseg_track( bin_f, track, is_drum )
-			track.sort_events_by_time()
+			out += sysex_cache[param1]
+			running = None
+		elif event_type == EventTypes.MARKER:
+			text = param1.encode( 'latin1' )
+			out += bytes( ( 0xff, 0x06 ) ) + encode_vlq( len( text ) ) + text
+			running = None
 
-			bin_f.seek( next_track_pos )
+	# end of track
+	out += bytes( ( 0x00, 0xff, 0x2f, 0x00 ) )
 
-	for i in range( 16 ):
-		track = parser.tracks[i]
-		handle_tempo_fades( bin_f, parser, i )
-		track.sort_events_by_time()
-		
-		if len( track.events ) != 0:
-			m_track = mido.MidiTrack()
-			mid_f.tracks.append( m_track )
-			track2midi( track, m_track )
+	yield out
+
+# Merge ( channel, rows ) pairs into one stream of ( channel, row ) pairs,
+# ordered by time and then channel; also returns the channels with rows
+def merge_tracks( tracks ) -> tuple:
+	heap = []
+
+	for channel, rows in tracks:
+		row = next( rows, None )
+
+		if row is not None:
+			heap.append( ( row[0], channel, row, rows ) )
+
+	heapq.heapify( heap )
+	channels = sorted( entry[1] for entry in heap )
+
+	def items():
+		while heap:
+			time, channel, row, rows = heap[0]
+			yield ( channel, row )
+
+			row = next( rows, None )
+
+			if row is None:
+				heapq.heappop( heap )
+			else:
+				heapq.heapreplace( heap, ( row[0], channel, row, rows ) )
 
-	mid_f.save( args.out_file )
+	return channels, items()
+
+#-----------------------------------------------------------
+
+# Write the event tables of the given tracks as a format 1 Standard MIDI File
+def write_smf( tracks: List[ParserTrack], ticks_per_beat: int = 48 ) -> bytes:
+	out = bytearray( b'MThd' )
+	out += struct.pack( '>Lhhh', 6, 1, len( tracks ), ticks_per_beat )
+
+	for track in tracks:
+		chunk = b''.join( track2smf( track.events.rows(), track.channel ) )
+		out += b'MTrk'
+		out += struct.pack( '>L', len( chunk ) )
+		out += chunk
+
+	return bytes( out )
+
+#-----------------------------------------------------------
+
+# Write ( channel, rows ) pairs to the seekable file `f` while they are
+# produced; format 0 consumes the tracks' rows interleaved
+def write_smf_stream( f: BinaryIO, tracks, ticks_per_beat: int = 48, stats: ConvertStats = None,
+	smf_format: int = 1 ) -> None:
+	write = f.write if stats is None else stats.timed_call( 'save', f.write )
+
+	start = f.tell()
+	write( b'MThd' + struct.pack( '>Lhhh', 6, smf_format, 0, ticks_per_beat ) )
+	count = 0
+
+	def write_chunk( pieces ) -> None:
+		chunk_start = f.tell()
+		write( b'MTrk\0\0\0\0' )
+		length = 0
+
+		if stats is not None:
+			pieces = stats.timed( 'midi_build', pieces )
+
+		for piece in pieces:
+			write( piece )
+			length += len( piece )
+
+		end = f.tell()
+		f.seek( chunk_start + 4 )
+		write( struct.pack( '>L', length ) )
+		f.seek( end )
+
+	if smf_format == 0:
+		channels, items = merge_tracks( tracks )
+		write_chunk( encode_smf_track( items, channels ) )
+		count = 1
+	else:
+		for channel, rows in tracks:
+			first = next( rows, None )
+
+			if first is None:
+				continue
+
+			write_chunk( track2smf( itertools.chain( ( first, ), rows ), channel ) )
+			count += 1
+
+	end = f.tell()
+	f.seek( start + 10 )
+	write( struct.pack( '>h', count ) )
+	f.seek( end )
+
+#-----------------------------------------------------------
+
+# Return the segment's offset, reading the EX tables unless the parser has them
+def load_song( reader: BgmReader, parser: Parser, segment: int ) -> int:
+	reader.seek( 0x14 + ( segment << 1 ) )
+
+	seg_ofs = reader.u16() << 2
+
+	if seg_ofs == 0:
+		raise BgmFormatError( 'Requested segment does not exist' )
+
+	if not parser.tables_loaded:
+		load_tables( reader, parser )
+
+	return seg_ofs
+
+# Read the EX drum and patch tables into the parser
+def load_tables( reader: BgmReader, parser: Parser ) -> None:
+	# ------------------------------------------------
+	# read from BGMFileInfo
+
+	reader.seek( 0x1c )
+	drums_ofs = reader.u16() << 2
+	drums_cnt = reader.u16()
+
+	patch_ofs = reader.u16() << 2
+	patch_cnt = reader.u16()
+
+	# ------------------------------------------------
+	# load EX drum data
+
+	reader.seek( drums_ofs )
+
+	for i in range( drums_cnt ):
+		# dummy read
+		reader.u8()
+
+		parser.add_drum( reader.u8() )
+		
+		# dummy read
+		reader.skip( 10 )
+
+	# ------------------------------------------------
+	# load EX patch data
+
+	reader.seek( patch_ofs )
+
+	for i in range( patch_cnt ):
+		bank	= reader.u8()
+		patch	= reader.u8()
+		parser.add_patch( bank, patch )
+
+		# dummy read
+		reader.skip( 6 )
+
+	parser.tables_loaded = True
+
+#-----------------------------------------------------------
+
+# ( sub_ofs, reuse ) of each subsegment the segment plays, with `reuse` set
+# for those played more than once, whose events are cached
+def get_subsegments( reader: BgmReader, seg_ofs: int ) -> List[tuple]:
+	commands = []
+	reader.seek( seg_ofs )
+
+	while True:
+		seg_cmd = reader.u16()
+		sub_ofs = reader.u16()
+
+		if seg_cmd == 0:
+			break
+
+		commands.append( sub_ofs )
+
+	uses = {}
+
+	for sub_ofs in commands:
+		uses[sub_ofs] = uses.get( sub_ofs, 0 ) + 1
+
+	return [( ( sub_ofs << 2 ) + seg_ofs, uses[sub_ofs] > 1 ) for sub_ofs in commands if sub_ofs != 0]
+
+#-----------------------------------------------------------
+
+# Parse the track's part of the subsegment at sub_ofs into track.events
+def parse_track_subsegment( reader: BgmReader, parser: Parser, track: ParserTrack, sub_ofs: int, reuse: bool ) -> None:
+	reader.seek( sub_ofs + ( track.channel << 2 ) )
+
+	track_ofs = reader.u16()
+
+	track_flags = reader.u16()
+	is_drum = track_flags & 0x0080 != 0 and parser.options.translate_drums == True
+
+	if track_ofs == 0:
+		return
+
+	track_ofs += sub_ofs
+
+	if reuse:
+		key = ( track_ofs, track.channel, is_drum, track.get_state() )
+		cached = parser.subseg_cache.get( key )
+
+		if cached is not None:
+			fragment, length, state = cached
+			track.events.extend( fragment, track.time_at )
+			track.time_at += length
+			track.set_state( state )
+			return
+
+		start = len( track.events )
+		start_time = track.time_at
+
+	reader.seek( track_ofs )
+	reader.reset_detour()
+
+	parse_subseg_track( reader, parser, track, is_drum )
+
+	if reuse:
+		parser.subseg_cache[key] = (
+			track.events.extract( start, start_time ), track.time_at - start_time, track.get_state() )
+
+#-----------------------------------------------------------
+
+# Yield one track's rows in time order, one subsegment at a time. The first
+# track fills the empty `sub_starts` with the subsegment start times; the
+# others need it filled first, or a `wait` function that fills it further.
+# With `with_subsegment` each row gets the index of its subsegment appended
+def stream_track( reader: BgmReader, parser: Parser, track: ParserTrack, subsegments: List[tuple],
+	sub_starts: List[int], stats: ConvertStats = None, wait = None, with_subsegment: bool = False ):
+	leader = len( sub_starts ) == 0
+	pending = []
+	seq = 0
+
+	parse = parse_track_subsegment
+	if stats is not None:
+		parse = stats.timed_call( 'parse', parse )
+
+	if leader:
+		sub_starts.append( track.time_at )
+
+	for i, ( sub_ofs, reuse ) in enumerate( subsegments ):
+		if not leader:
+			if wait is not None:
+				wait( i + 2 )
+			track.time_at = sub_starts[i]
+
+		track.events = EventTable()
+		parse( reader, parser, track, sub_ofs, reuse )
+		track.events.sort()
+
+		if leader:
+			sub_starts.append( track.time_at )
+
+		for row in track.events.rows():
+			heapq.heappush( pending, ( row[0], seq, row, i ) )
+			seq += 1
+
+		# later subsegments start no earlier than where the next one starts
+		release_time = sub_starts[i + 1]
+
+		while pending and pending[0][0] < release_time:
+			entry = heapq.heappop( pending )
+			yield entry[2] + ( entry[3], ) if with_subsegment else entry[2]
+
+	track.events = EventTable()
+
+	while pending:
+		entry = heapq.heappop( pending )
+		yield entry[2] + ( entry[3], ) if with_subsegment else entry[2]
+
+#-----------------------------------------------------------
+
+# reader, parser and subsegments of the segment a track worker process parses
+track_worker = None
+
+def init_track_worker( data: bytes, options: ConvertOptions, segment: int ) -> None:
+	global track_worker
+
+	reader = BgmReader( data )
+	parser = Parser( options )
+
+	# the main process has already warned about the EX drums
+	with warnings.catch_warnings():
+		warnings.simplefilter( 'ignore', BgmWarning )
+		seg_ofs = load_song( reader, parser, segment )
+
+	track_worker = ( reader, parser, get_subsegments( reader, seg_ofs ) )
+
+# Parse one track in a worker process, returning its events and, if
+# `count` is set, its ConvertStats counters
+def parse_track_job( job: tuple ) -> tuple:
+	channel, sub_starts, count = job
+	reader, parser, subsegments = track_worker
+	stats = None
+
+	if count:
+		stats = ConvertStats()
+		reader = StatsBgmReader( reader.data, stats )
+
+	table = EventTable.from_rows( stream_track( reader, parser, ParserTrack( channel ), subsegments, sub_starts, stats ) )
+	return table, None if stats is None else stats.counters()
+
+# Rows of each of parser.tracks; the first track sets the subsegment start
+# times here, then the others are parsed by `jobs` worker processes
+def parse_tracks_parallel( reader: BgmReader, parser: Parser, segment: int, subsegments: List[tuple],
+	sub_starts: List[int], jobs: int, stats: ConvertStats = None ) -> list:
+	import concurrent.futures
+
+	with concurrent.futures.ProcessPoolExecutor( max_workers = jobs, initializer = init_track_worker,
+		initargs = ( bytes( reader.data ), parser.options, segment ) ) as pool:
+		leader = list( stream_track( reader, parser, parser.tracks[0], subsegments, sub_starts, stats ) )
+		results = pool.map( parse_track_job,
+			[( track.channel, sub_starts, stats is not None ) for track in parser.tracks[1:]] )
+		tracks = [iter( leader )]
+
+		for table, counters in results:
+			if counters is not None:
+				stats.add_counters( counters )
+
+			tracks.append( table.rows() )
+
+		return tracks
+
+#-----------------------------------------------------------
+
+# Yield ( track, rows ) for the 16 tracks of a segment, with fades expanded.
+# Each track's rows must be consumed before the next's unless `interleave`
+# is set. `data` may be bytes or a BgmReader
+def iter_song_tracks( data, segment: int, options: ConvertOptions = None, parser: Parser = None,
+	stats: ConvertStats = None, interleave: bool = False, jobs: int = 1 ):
+	if options is None:
+		options = ConvertOptions()
+
+	if parser is None:
+		parser = Parser( options )
+
+	reader = data if isinstance( data, BgmReader ) else BgmReader( data )
+
+	if stats is not None:
+		reader = StatsBgmReader( reader.data, stats )
+		stats.enter( 'header' )
+
+	seg_ofs = load_song( reader, parser, segment )
+	subsegments = get_subsegments( reader, seg_ofs )
+	sub_starts = []
+
+	if stats is not None:
+		stats.leave()
+
+	for i in range( 16 ):
+		parser.add_track()
+
+	wait = None
+	track_rows = None
+
+	if jobs > 1:
+		track_rows = parse_tracks_parallel( reader, parser, segment, subsegments, sub_starts, jobs, stats )
+	elif interleave:
+		leader_rows = stream_track( reader, parser, parser.tracks[0], subsegments, sub_starts, stats )
+		buffered = collections.deque()
+
+		def wait( count: int ) -> None:
+			while len( sub_starts ) < count:
+				row = next( leader_rows, None )
+				if row is None:
+					break
+				buffered.append( row )
+
+		def leader():
+			while True:
+				if buffered:
+					yield buffered.popleft()
+				else:
+					row = next( leader_rows, None )
+					if row is None:
+						return
+					yield row
+
+	for track in parser.tracks:
+		if track_rows is not None:
+			rows = track_rows[track.channel]
+		elif interleave and track.channel == 0:
+			rows = leader()
+		else:
+			rows = stream_track( reader, parser, track, subsegments, sub_starts, stats, wait )
+
+		if stats is None:
+			rows = stream_ramps( rows, options )
+
+			if options.optimize:
+				rows = optimize_rows( rows, parser.removed )
+		else:
+			rows = stream_ramps( stats.timed( 'sort', rows ), options )
+			rows = stats.timed( 'ramps', rows )
+
+			if options.optimize:
+				rows = stats.timed( 'optimize', optimize_rows( rows, parser.removed ) )
+
+			rows = stats.count_events( rows )
+
+		yield ( track, rows )
+
+#-----------------------------------------------------------
+
+# Parse one segment of a BGM into an event table per channel
+def parse_song( data, segment: int, options: ConvertOptions = None, parser: Parser = None,
+	stats: ConvertStats = None, jobs: int = 1 ) -> Parser:
+	if parser is None:
+		parser = Parser( options )
+
+	for track, rows in iter_song_tracks( data, segment, options, parser, stats, jobs = jobs ):
+		track.events = EventTable.from_rows( rows )
+
+	return parser
+
+#-----------------------------------------------------------
+
+# Convert one segment of a BGM to a mido.MidiFile
+def convert( data, segment: int, options: ConvertOptions = None ) -> 'mido.MidiFile':
+	if import_mido() is None:
+		raise ImportError( 'convert() requires mido; use convert_to_bytes() without it' )
+
+	if options is not None and options.smf_format == 0:
+		# read back the native writer's merged track, so both paths order
+		# events at the same tick the same way
+		return mido.MidiFile( file = io.BytesIO( convert_to_bytes( data, segment, options ) ) )
+
+	parser = parse_song( data, segment, options )
+	mid_f = mido.MidiFile( type = 1 )
+	mid_f.ticks_per_beat = 48
+
+	for track in parser.tracks:
+		if len( track.events ) != 0:
+			m_track = mido.MidiTrack()
+			mid_f.tracks.append( m_track )
+			track2midi( track, m_track )
+
+	return mid_f
+
+#-----------------------------------------------------------
+
+# Convert one segment of a BGM to Standard MIDI File bytes, without mido
+def convert_to_bytes( data, segment: int, options: ConvertOptions = None ) -> bytes:
+	out = io.BytesIO()
+	convert_to_stream( data, segment, out, options )
+	return out.getvalue()
+
+#-----------------------------------------------------------
+
+# Convert one segment of a BGM, writing the MIDI file to the seekable `f` as
+# it is parsed
+def convert_to_stream( data, segment: int, f: BinaryIO, options: ConvertOptions = None,
+	stats: ConvertStats = None, parser: Parser = None, jobs: int = 1 ) -> None:
+	if options is None:
+		options = ConvertOptions()
+
+	merge = options.smf_format == 0
+	tracks = iter_song_tracks( data, segment, options, parser, stats, interleave = merge, jobs = jobs )
+	write_smf_stream( f, ( ( track.channel, rows ) for track, rows in tracks ), stats = stats,
+		smf_format = options.smf_format )
+
+#-----------------------------------------------------------
+
+IR_MAGIC	= b'PMIR'
+IR_VERSION	= 1
+# magic, version, column count, row count, JSON header size
+IR_HEADER	= struct.Struct( '<4sHHLL' )
+# each column is an array of little-endian 32-bit integers, one per row
+IR_COLUMNS	= ( 'time', 'type', 'offset', 'param1', 'param2', 'channel', 'subsegment' )
+
+# Write one segment's rows, after fade expansion but before --optimize, to
+# `f` as an IR file: IR_HEADER, a JSON header padded to 4 bytes, then each
+# of IR_COLUMNS as a fixed-width array of all rows
+def dump_ir( data, segment: int, f: BinaryIO, options: ConvertOptions = None, parser: Parser = None ) -> None:
+	if options is None:
+		options = ConvertOptions()
+
+	if parser is None:
+		parser = Parser( options )
+
+	reader = data if isinstance( data, BgmReader ) else BgmReader( data )
+	seg_ofs = load_song( reader, parser, segment )
+	subsegments = get_subsegments( reader, seg_ofs )
+	sub_starts = []
+
+	for i in range( 16 ):
+		parser.add_track()
+
+	columns = [array( 'i' ) for name in IR_COLUMNS]
+	payloads = []
+	tracks = []
+
+	for track in parser.tracks:
+		first = len( columns[0] )
+		rows = stream_track( reader, parser, track, subsegments, sub_starts, with_subsegment = True )
+
+		# events generated from a fade or note keep the subsegment of that row
+		for time, event_type, offset, param1, param2, subsegment in stream_ramps( rows, options ):
+			if event_type == EventTypes.SYSEX or event_type == EventTypes.MARKER:
+				payloads.append( param1 )
+				param1 = len( payloads ) - 1
+
+			for column, value in zip( columns, ( time, event_type, offset, param1, param2, track.channel, subsegment ) ):
+				column.append( value )
+
+		tracks.append( ( track.channel, first, len( columns[0] ) - first ) )
+
+	header = json.dumps( {
+		'segment'		: segment,
+		'ticks_per_beat': 48,
+		'options'		: vars( options ),
+		'sub_starts'	: sub_starts,
+		'tracks'		: tracks,
+		'data'			: payloads,
+	} ).encode()
+	header += b' ' * ( -len( header ) % 4 )
+
+	f.write( IR_HEADER.pack( IR_MAGIC, IR_VERSION, len( IR_COLUMNS ), len( columns[0] ), len( header ) ) )
+	f.write( header )
+
+	for column in columns:
+		if sys.byteorder != 'little':
+			column.byteswap()
+		f.write( column.tobytes() )
+
+# An IR file mapped read-only; `tracks` holds ( channel, EventTable ) pairs
+# whose columns are slices of the mapping
+class IrFile:
+	def __init__( self, path: str ):
+		with open( path, 'rb' ) as f:
+			data = memoryview( map_file( f ) )
+
+		if len( data ) < IR_HEADER.size:
+			raise ValueError( '{} is not an IR file'.format( path ) )
+
+		magic, version, column_count, count, header_size = IR_HEADER.unpack_from( data )
+
+		if magic != IR_MAGIC or version != IR_VERSION or column_count != len( IR_COLUMNS ):
+			raise ValueError( '{} is not a version {:d} IR file'.format( path, IR_VERSION ) )
+
+		start = IR_HEADER.size + header_size
+
+		if len( data ) != start + len( IR_COLUMNS ) * count * 4:
+			raise ValueError( '{} is truncated'.format( path ) )
+
+		header = json.loads( bytes( data[IR_HEADER.size:start] ) )
+		self.segment		= header['segment']
+		self.ticks_per_beat	= header['ticks_per_beat']
+		self.options		= ConvertOptions( **header['options'] )
+		self.sub_starts		= header['sub_starts']
+		self.columns		= {}
+
+		for i, name in enumerate( IR_COLUMNS ):
+			column = data[start + i * count * 4:start + ( i + 1 ) * count * 4].cast( 'i' )
+
+			if sys.byteorder != 'little':
+				column = array( 'i', column )
+				column.byteswap()
+
+			self.columns[name] = column
+
+		# JSON turns the sysex tuples into lists
+		payloads = [tuple( payload ) if isinstance( payload, list ) else payload for payload in header['data']]
+		self.tracks = []
+
+		for channel, first, count in header['tracks']:
+			table = EventTable()
+
+			for name in ( 'time', 'type', 'offset', 'param1', 'param2' ):
+				setattr( table, name, self.columns[name][first:first + count] )
+
+			table.data = payloads
+			self.tracks.append( ( channel, table ) )
+
+# Write the MIDI file for an IrFile; only --optimize and --format of
+# `options` apply, the rest were applied when it was dumped
+def convert_ir( ir: IrFile, f: BinaryIO, options: ConvertOptions = None, removed: List[int] = None ) -> None:
+	if options is None:
+		options = ConvertOptions()
+
+	if removed is None:
+		removed = [0] * len( EventTypes )
+
+	def tracks():
+		for channel, table in ir.tracks:
+			rows = table.rows()
+
+			if options.optimize:
+				rows = optimize_rows( rows, removed )
+
+			yield ( channel, rows )
+
+	write_smf_stream( f, tracks(), ir.ticks_per_beat, smf_format = options.smf_format )
+
+#-----------------------------------------------------------
+
+# Walk one track the way parse_subseg_track reads it, noting what it plays.
+# Bad offsets, reads past the end and detours that never return end the
+# walk and are listed under 'issues'
+def scan_track( data: bytes, size: int, track_ofs: int, is_drum: bool ) -> dict:
+	pos = track_ofs
+	time_at = 0
+	remain = 0
+	# ( return position, remaining count, ( target, length ) ) of the detours
+	# being followed; taking one of them again inside it recurses forever
+	stack = []
+	active = set()
+	visited = {}
+
+	notes = 0
+	detours = 0
+	tempo = []
+	fades = []
+	drum_notes = set()
+	patches = set()
+	patch_sets = set()
+	untranslated = {}
+	issues = []
+	loop = None
+	dispatch = cmd_dispatch
+
+	def read_byte() -> int:
+		# one byte at a time for notes and delta times ending a detour midway.
+		# Like the converter's reader, this gives zeros past the end of the file
+		nonlocal pos, remain
+		value = data[pos] if pos < size else 0
+		pos += 1
+		if remain:
+			remain -= 1
+			if remain == 0:
+				pos, remain, key = stack.pop()
+				active.discard( key )
+		return value
+
+	while True:
+		if pos >= size:
+			issues.append( ( pos, 'track runs past the end of the file' ) )
+			break
+
+		if remain == 0:
+			visited[pos] = time_at
+
+		cmd = data[pos]
+		pos += 1
+
+		if cmd == 0:
+			break
+
+		if remain:
+			remain -= 1
+			if remain == 0:
+				pos, remain, key = stack.pop()
+				active.discard( key )
+
+		# delta time
+		if cmd < 0x80:
+			if cmd >= 0x78:
+				time_at += ( ( cmd & 7 ) << 8 ) + read_byte() + 0x78
+			else:
+				time_at += cmd
+		# note event
+		elif cmd < 0xd4:
+			count = 3 if pos + 1 < size and data[pos + 1] >= 0xc0 else 2
+
+			if remain == 0 or remain >= count:
+				if pos + count > size:
+					issues.append( ( pos - 1, 'note runs past the end of the file' ) )
+					break
+
+				pos += count
+
+				if remain:
+					remain -= count
+					if remain == 0:
+						pos, remain, key = stack.pop()
+						active.discard( key )
+			else:
+				read_byte()
+				if read_byte() >= 0xc0:
+					read_byte()
+
+			notes += 1
+
+			if is_drum:
+				drum_notes.add( cmd & 0x7f )
+		# commands
+		elif cmd >= 0xe0:
+			operands, count, handler = dispatch[cmd]
+
+			if operands is None:
+				args = ()
+			elif pos + operands.size > size:
+				issues.append( ( pos - 1, 'command {:02X} runs past the end of the file'.format( cmd ) ) )
+				break
+			else:
+				args = operands.unpack_from( data, pos )
+				pos += operands.size
+
+			if cmd == 0xfe:
+				target, length = args
+				detours += 1
+
+				if target >= size:
+					issues.append( ( pos - 4, 'detour to {:04X} is outside the file'.format( target ) ) )
+					break
+
+				if args in active:
+					issues.append( ( pos - 4, 'detour to {:04X} never returns'.format( target ) ) )
+					break
+
+				stack.append( ( pos, remain, args ) )
+				active.add( args )
+				pos = target
+				remain = length
+				continue
+
+			if cmd == 0xfc:
+				table = args[0]
+
+				if table + 2 > size:
+					issues.append( ( pos - 4, 'jump table at {:04X} is outside the file'.format( table ) ) )
+					break
+
+				target = ( data[table] << 8 ) | data[table + 1]
+
+				if target in visited:
+					loop = ( visited[target], time_at )
+					break
+
+				if target >= size:
+					issues.append( ( pos - 4, 'jump to {:04X} is outside the file'.format( target ) ) )
+					break
+
+				stack.clear()
+				active.clear()
+				remain = 0
+				pos = target
+				continue
+
+			if handler is None:
+				untranslated[cmd] = untranslated.get( cmd, 0 ) + 1
+			elif cmd == 0xe0:
+				tempo.append( ( time_at, args[0] ) )
+			elif cmd == 0xe4:
+				fades.append( ( time_at, args[0], args[1] ) )
+			elif cmd == 0xe8:
+				patches.add( args )
+			elif cmd == 0xf5:
+				patch_sets.add( args[0] )
+
+			if remain:
+				remain -= count
+				if remain <= 0:
+					pos, remain, key = stack.pop()
+					active.discard( key )
+		# 0xD4-0xDF do nothing
+		else:
+			untranslated[cmd] = untranslated.get( cmd, 0 ) + 1
+
+	return {
+		'ticks'			: time_at,
+		'notes'			: notes,
+		'detours'		: detours,
+		'tempo'			: tempo,
+		'tempo_fades'	: fades,
+		'drum_notes'	: drum_notes,
+		'patches'		: patches,
+		'patch_sets'	: patch_sets,
+		'untranslated'	: untranslated,
+		'loop'			: loop,
+		'issues'		: issues,
+	}
+
+# Report on every segment of a BGM without converting it: length, tempo,
+# channels, drums, patches, untranslated commands, loops and problems
+def inspect_song( data ) -> dict:
+	reader = data if isinstance( data, BgmReader ) else BgmReader( data )
+	size = reader.size
+	data = bytes( reader.data )
+	issues = []
+
+	def issue( segment, channel, offset, message ) -> None:
+		issues.append( { 'segment': segment, 'channel': channel, 'offset': offset, 'message': message } )
+
+	if size < 0x24 or bytes( reader.data[:4] ) != b'BGM ':
+		issue( None, None, 0, 'not a BGM file' )
+		return { 'size': size, 'issues': issues }
+
+	drums_ofs, drums_cnt, patch_ofs, patch_cnt = struct.unpack_from( '>HHHH', data, 0x1c )
+	drums_ofs <<= 2
+	patch_ofs <<= 2
+
+	if drums_ofs + drums_cnt * 12 > size:
+		issue( None, None, 0x1c, 'EX drum table is outside the file' )
+		drums_cnt = 0
+
+	if patch_ofs + patch_cnt * 8 > size:
+		issue( None, None, 0x20, 'EX patch table is outside the file' )
+		patch_cnt = 0
+
+	ex_drums = [data[drums_ofs + i * 12 + 1] for i in range( drums_cnt )]
+	ex_patches = [list( data[patch_ofs + i * 8:patch_ofs + i * 8 + 2] ) for i in range( patch_cnt )]
+
+	scans = {}
+	reported = set()
+	segments = []
+	drum_notes = set()
+	patches = set()
+	patch_sets = set()
+	untranslated = collections.Counter()
+	detours = 0
+
+	for segment in get_segments( reader ):
+		seg_ofs = struct.unpack_from( '>H', data, 0x14 + ( segment << 1 ) )[0] << 2
+
+		if seg_ofs >= size:
+			issue( segment, None, 0x14 + ( segment << 1 ), 'segment is outside the file' )
+			continue
+
+		subsegments = get_subsegments( reader, seg_ofs )
+		time_at = 0
+		notes = 0
+		channels = set()
+		drum_channels = set()
+		tempo = []
+		fades = []
+		loops = []
+
+		for sub_ofs, reuse in subsegments:
+			if sub_ofs + 0x40 > size:
+				issue( segment, None, sub_ofs, 'subsegment is outside the file' )
+				continue
+
+			start = time_at
+
+			for channel in range( 16 ):
+				track_ofs, flags = struct.unpack_from( '>HH', data, sub_ofs + ( channel << 2 ) )
+
+				if track_ofs == 0:
+					continue
+
+				track_ofs += sub_ofs
+
+				if track_ofs >= size:
+					issue( segment, channel, sub_ofs + ( channel << 2 ), 'track is outside the file' )
+					continue
+
+				is_drum = flags & 0x0080 != 0
+				key = ( track_ofs, is_drum )
+				scan = scans.get( key )
+
+				if scan is None:
+					scan = scans[key] = scan_track( data, size, track_ofs, is_drum )
+					detours += scan['detours']
+					drum_notes |= scan['drum_notes']
+					patches |= scan['patches']
+					patch_sets |= scan['patch_sets']
+					untranslated.update( scan['untranslated'] )
+
+				if track_ofs not in reported:
+					reported.add( track_ofs )
+
+					for offset, message in scan['issues']:
+						issue( segment, channel, offset, message )
+
+				channels.add( channel )
+				notes += scan['notes']
+
+				if is_drum:
+					drum_channels.add( channel )
+
+				tempo.extend( [start + tick, bpm] for tick, bpm in scan['tempo'] )
+				fades.extend( [start + tick, duration, bpm] for tick, duration, bpm in scan['tempo_fades'] )
+
+				if scan['loop'] is not None:
+					loops.append( [channel, start + scan['loop'][0], start + scan['loop'][1]] )
+
+				# every subsegment starts where the first track got to
+				if channel == 0:
+					time_at = start + scan['ticks']
+
+		segments.append( {
+			'segment'		: segment,
+			'subsegments'	: len( subsegments ),
+			'ticks'			: time_at,
+			'channels'		: sorted( channels ),
+			'drum_channels'	: sorted( drum_channels ),
+			'notes'			: notes,
+			'tempo'			: sorted( tempo ),
+			'tempo_fades'	: sorted( fades ),
+			'loops'			: loops,
+		} )
+
+	# drums the converter cannot translate with -t, and patches it cannot look up
+	for note in sorted( drum_notes ):
+		if note not in drum_map and not 0 <= note - 72 < drums_cnt:
+			issue( None, None, None, 'drum {:d} is not in the translation map'.format( note ) )
+
+	for index in sorted( patch_sets ):
+		if index >= patch_cnt:
+			issue( None, None, None, 'patch set {:d} is not in the EX patch table'.format( index ) )
+
+	return {
+		'name'			: bytes( reader.data[8:12] ).decode( 'ascii', 'replace' ).rstrip( '\0 ' ),
+		'size'			: size,
+		'ex_drums'		: ex_drums,
+		'ex_patches'	: ex_patches,
+		'segments'		: segments,
+		'drum_notes'	: sorted( drum_notes ),
+		'patches'		: sorted( list( patch ) for patch in patches ),
+		'patch_sets'	: sorted( patch_sets ),
+		'untranslated'	: { '{:02X} {}'.format( cmd, cmd_names.get( cmd, 'unknown' ) ): count
+			for cmd, count in sorted( untranslated.items() ) },
+		'detours'		: detours,
+		'issues'		: issues,
+	}
+
+#-----------------------------------------------------------
+
+# On-disk cache of converted MIDI files, keyed by the BGM, segment, options
+# and converter source, dropping the least recently used past `max_size`
+class ConversionCache:
+	def __init__( self, path: str, max_size: int = 256 << 20 ):
+		self.path		= path
+		self.max_size	= max_size
+		self.hits		= 0
+		self.misses		= 0
+
+	def key( self, data, segment: int, options: ConvertOptions ) -> str:
+		h = hashlib.sha256( converter_hash().encode() )
+		h.update( repr( ( segment, sorted( vars( options ).items() ) ) ).encode() )
+		h.update( data )
+		return h.hexdigest()
+
+	def entry_path( self, key: str ) -> str:
+		return os.path.join( self.path, key + '.mid' )
+
+	def get( self, key: str ):
+		path = self.entry_path( key )
+
+		try:
+			with open( path, 'rb' ) as f:
+				data = f.read()
+			# mark as recently used
+			os.utime( path )
+		except OSError:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		return data
+
+	def put( self, key: str, data: bytes ) -> None:
+		os.makedirs( self.path, exist_ok = True )
+
+		# write under a temporary name so concurrent readers never see a partial entry
+		tmp_path = self.entry_path( key ) + '.{:d}.tmp'.format( os.getpid() )
+
+		with open( tmp_path, 'wb' ) as f:
+			f.write( data )
+
+		os.replace( tmp_path, self.entry_path( key ) )
+		self.evict()
+
+	def evict( self ) -> None:
+		entries = []
+		total = 0
+
+		for entry in os.scandir( self.path ):
+			if entry.name.endswith( '.mid' ):
+				try:
+					stat = entry.stat()
+				except OSError:
+					continue
+				entries.append( ( stat.st_mtime, stat.st_size, entry.path ) )
+				total += stat.st_size
+
+		entries.sort()
+
+		for mtime, size, path in entries:
+			if total <= self.max_size:
+				break
+
+			try:
+				os.remove( path )
+			except OSError:
+				# already removed by another process
+				pass
+
+			total -= size
+
+#-----------------------------------------------------------
+
+converter_digest = None
+
+# hash of this script's source, so the cache misses whenever the converter changes
+def converter_hash() -> str:
+	global converter_digest
+
+	if converter_digest is None:
+		with open( os.path.abspath( __file__ ), 'rb' ) as f:
+			converter_digest = hashlib.sha256( f.read() ).hexdigest()
+
+	return converter_digest
+
+#-----------------------------------------------------------
+
+def default_index_dir() -> str:
+	cache_home = os.environ.get( 'XDG_CACHE_HOME' ) or os.path.join( os.path.expanduser( '~' ), '.cache' )
+	return os.path.join( cache_home, 'pm64-to-midi' )
+
+# The BGM files of an SBN archive, on its own or in a .z64 ROM image. The
+# index of ( name, offset, size ) entries is cached in `index_dir`
+class BgmArchive:
+	INDEX_VERSION = 1
+
+	def __init__( self, path: str, index_dir: str = None ):
+		self.path		= os.path.abspath( path )
+		self.index_dir	= index_dir if index_dir is not None else default_index_dir()
+		self.data		= None
+
+		stat = os.stat( self.path )
+		self.file_id = [self.path, stat.st_size, stat.st_mtime_ns]
+
+		self.entries = self.load_index()
+
+		if self.entries is None:
+			self.entries = self.build_index()
+			self.save_index()
+
+	# True unless `path` is a plain BGM file
+	@staticmethod
+	def is_archive( path: str ) -> bool:
+		with open( path, 'rb' ) as f:
+			return f.read( 4 ) != b'BGM '
+
+	def index_path( self ) -> str:
+		key = hashlib.sha256( repr( self.file_id ).encode() ).hexdigest()
+		return os.path.join( self.index_dir, 'index-' + key[:32] + '.json' )
+
+	def load_index( self ):
+		try:
+			with open( self.index_path() ) as f:
+				index = json.load( f )
+		except ( OSError, ValueError ):
+			return None
+
+		if index.get( 'version' ) != self.INDEX_VERSION or index.get( 'file' ) != self.file_id:
+			return None
+
+		return [tuple( entry ) for entry in index['entries']]
+
+	def save_index( self ) -> None:
+		index = { 'version': self.INDEX_VERSION, 'file': self.file_id, 'entries': self.entries }
+
+		# the index only saves time, so failing to write it is not an error
+		try:
+			os.makedirs( self.index_dir, exist_ok = True )
+			tmp_path = self.index_path() + '.{:d}.tmp'.format( os.getpid() )
+
+			with open( tmp_path, 'w' ) as f:
+				json.dump( index, f )
+
+			os.replace( tmp_path, self.index_path() )
+		except OSError:
+			pass
+
+	def map( self ) -> memoryview:
+		if self.data is None:
+			with open( self.path, 'rb' ) as f:
+				self.data = memoryview( map_file( f ) )
+
+		return self.data
+
+	# Return the offset of the SBN archive in the file
+	def find_sbn( self ) -> int:
+		data = self.map()
+		raw = data.obj
+
+		if bytes( data[:4] ) in ( b'\x37\x80\x40\x12', b'\x40\x12\x37\x80' ):
+			raise BgmFormatError( 'Byte-swapped ROM images are not supported; convert it to .z64 first' )
+
+		pos = raw.find( b'SBN ' )
+
+		while pos >= 0:
+			# the header gives the archive's size and the location of its file table
+			if pos + 0x18 <= len( data ):
+				size, = struct.unpack_from( '>L', data, pos + 4 )
+				table_ofs, count = struct.unpack_from( '>LL', data, pos + 0x10 )
+
+				if pos + size <= len( data ) and table_ofs + count * 8 <= size and 0 < count < 0x1000:
+					return pos
+
+			pos = raw.find( b'SBN ', pos + 1 )
+
+		raise BgmFormatError( '{} is not a BGM file, SBN archive or Paper Mario ROM'.format( self.path ) )
+
+	def build_index( self ) -> List[tuple]:
+		data = self.map()
+		sbn_ofs = self.find_sbn()
+		table_ofs, count = struct.unpack_from( '>LL', data, sbn_ofs + 0x10 )
+		entries = []
+
+		for i in range( count ):
+			file_ofs, file_info = struct.unpack_from( '>LL', data, sbn_ofs + table_ofs + i * 8 )
+			offset = sbn_ofs + file_ofs
+			# the top byte holds the file type
+			size = file_info & 0xffffff
+
+			if offset + size > len( data ) or bytes( data[offset:offset + 4] ) != b'BGM ':
+				continue
+
+			name = bytes( data[offset + 8:offset + 12] ).decode( 'ascii', 'replace' ).rstrip( '\0 ' )
+			entries.append( ( name, offset, size ) )
+
+		return entries
+
+	# Look up an entry by name, or by its position in the index
+	def find( self, song: str ) -> tuple:
+		for entry in self.entries:
+			if entry[0] == song:
+				return entry
+
+		if song.isdigit() and int( song ) < len( self.entries ):
+			return self.entries[int( song )]
+
+		raise BgmFormatError( 'No song named {} in {}'.format( song, self.path ) )
+
+	def reader( self, entry: tuple ) -> BgmReader:
+		name, offset, size = entry
+		return BgmReader( self.map()[offset:offset + size] )
+
+	def print_list( self ) -> None:
+		for i, ( name, offset, size ) in enumerate( self.entries ):
+			print( '{:4d}  {:8s}  {:08X}  {:6d}'.format( i, name, offset, size ) )
+
+#-----------------------------------------------------------
+
+# Convert one segment of a BGM file to a MIDI file, returning True if it
+# came from `cache`
+def convert_file( in_file, segment: int, out_file: str, options: ConvertOptions = None,
+	cache: ConversionCache = None, stats: ConvertStats = None, parser: Parser = None, jobs: int = 1 ) -> bool:
+	if options is None:
+		options = ConvertOptions()
+
+	reader = in_file if isinstance( in_file, BgmReader ) else BgmReader.open( in_file )
+	data = None
+
+	if cache is not None:
+		key = cache.key( reader.data, segment, options )
+		data = cache.get( key )
+
+	hit = data is not None
+
+	with open( out_file, 'w+b' if cache is not None else 'wb' ) as f:
+		if hit:
+			f.write( data )
+			if stats is not None:
+				stats.cache_hit = True
+			return True
+
+		try:
+			convert_to_stream( reader, segment, f, options, stats, parser, jobs )
+		except BaseException:
+			# don't leave a partially written file behind
+			f.close()
+			os.remove( out_file )
+			raise
+
+		if stats is not None:
+			import tracemalloc
+
+			if not tracemalloc.is_tracing():
+				# the first conversion already warned about anything in the song
+				with open( os.devnull, 'wb' ) as null, warnings.catch_warnings():
+					warnings.simplefilter( 'ignore', BgmWarning )
+					tracemalloc.start()
+					try:
+						convert_to_stream( reader, segment, null, options )
+						stats.peak_memory = tracemalloc.get_traced_memory()[1]
+					finally:
+						tracemalloc.stop()
+
+		if cache is not None:
+			f.seek( 0 )
+			cache.put( key, f.read() )
+
+	return False
+
+#-----------------------------------------------------------
+
+# Name the MIDI file of one segment after `out_file`, at {segment} or before the extension
+def segment_file_name( out_file: str, segment: int ) -> str:
+	if '{segment}' in out_file:
+		return out_file.replace( '{segment}', str( segment ) )
+
+	root, ext = os.path.splitext( out_file )
+	return '{}_{:d}{}'.format( root, segment, ext )
+
+# ( channel, rows ) of parsed segments played one after another, each
+# starting with a 'segment N' marker
+def chain_tracks( parsers: List[Parser], segments: List[int] ):
+	starts = []
+	start = 0
+
+	for parser in parsers:
+		starts.append( start )
+		# the first track ends where the last subsegment does
+		end = parser.tracks[0].time_at
+
+		for track in parser.tracks:
+			if len( track.events ) != 0:
+				end = max( end, track.events.time[-1] )
+
+		start += end
+
+	for channel in range( 16 ):
+		def rows( channel = channel ):
+			for parser, segment, start in zip( parsers, segments, starts ):
+				if channel == 0:
+					yield ( start, EventTypes.MARKER, 0, 'segment {:d}'.format( segment ), 0 )
+
+				for time, event_type, offset, param1, param2 in parser.tracks[channel].events.rows():
+					yield ( time + start, event_type, offset, param1, param2 )
+
+		yield ( channel, rows() )
+
+# Convert every segment of a BGM file to a MIDI file each, or with `chain`
+# to one file, returning the segments found
+def convert_all_segments( in_file, out_file: str, options: ConvertOptions = None, cache: ConversionCache = None,
+	stats: ConvertStats = None, chain: bool = False, parser: Parser = None, jobs: int = 1 ) -> List[int]:
+	reader = in_file if isinstance( in_file, BgmReader ) else BgmReader.open( in_file )
+	segments = get_segments( reader )
+
+	if not segments:
+		raise BgmFormatError( 'The BGM has no segments' )
+
+	if parser is None:
+		parser = Parser( options )
+
+	if not parser.tables_loaded:
+		load_tables( reader, parser )
+
+	if not chain:
+		for segment in segments:
+			convert_file( reader, segment, segment_file_name( out_file, segment ), options, cache, stats, parser.fork(), jobs )
+		return segments
+
+	parsers = [parse_song( reader, segment, options, parser.fork(), stats, jobs ) for segment in segments]
+
+	with open( out_file, 'wb' ) as f:
+		write_smf_stream( f, chain_tracks( parsers, segments ), stats = stats, smf_format = parser.options.smf_format )
+
+	return segments
+
+#-----------------------------------------------------------
+
+# Dump one or 'all' segments to IR files, and with `out_file`, write the
+# MIDI files from those
+def dump_ir_files( in_file, segment, ir_file: str, out_file: str = None, options: ConvertOptions = None,
+	parser: Parser = None ) -> None:
+	reader = in_file if isinstance( in_file, BgmReader ) else BgmReader.open( in_file )
+
+	if parser is None:
+		parser = Parser( options )
+
+	if segment != 'all':
+		files = [( segment, ir_file, out_file )]
+	else:
+		segments = get_segments( reader )
+
+		if not segments:
+			raise BgmFormatError( 'The BGM has no segments' )
+
+		if not parser.tables_loaded:
+			load_tables( reader, parser )
+
+		files = [( segment, segment_file_name( ir_file, segment ),
+			segment_file_name( out_file, segment ) if out_file is not None else None ) for segment in segments]
+
+	for segment, ir_file, out_file in files:
+		with open( ir_file, 'wb' ) as f:
+			dump_ir( reader, segment, f, parser.options, parser.fork() )
+
+		if out_file is not None:
+			with open( out_file, 'wb' ) as f:
+				convert_ir( IrFile( ir_file ), f, parser.options, parser.removed )
+
+#-----------------------------------------------------------
+
+# Messages setting the pitch bend sensitivity to +/-24 semitones (RPN 0,0 data entry 24)
+def rpn_messages( channel: int ) -> List[bytes]:
+	control = 0xb0 | channel
+	return [bytes( ( control, 101, 0 ) ), bytes( ( control, 100, 0 ) ), bytes( ( control, 6, 24 ) )]
+
+# Encode one row as complete MIDI messages, without running status. Meta events give none
+def event_messages( channel: int, row: tuple ) -> List[bytes]:
+	time, event_type, offset, param1, param2 = row
+
+	if event_type == EventTypes.NOTE_OFF or event_type == EventTypes.NOTE_ON or event_type == EventTypes.CC:
+		if ( param1 | param2 ) & ~0x7f:
+			raise ValueError( 'data byte must be in range 0..127' )
+
+		status = 0x80 if event_type == EventTypes.NOTE_OFF else 0x90 if event_type == EventTypes.NOTE_ON else 0xb0
+		return [bytes( ( status | channel, param1, param2 ) )]
+	elif event_type == EventTypes.PROGRAM:
+		if ( param1 | param2 ) & ~0x7f:
+			raise ValueError( 'data byte must be in range 0..127' )
+
+		# bank select MSB, then the program change
+		return [bytes( ( 0xb0 | channel, 0, param1 ) ), bytes( ( 0xc0 | channel, param2 ) )]
+	elif event_type == EventTypes.WHEEL:
+		pitch = max( min( param1, 8191 ), -8192 ) + 8192
+		return [bytes( ( 0xe0 | channel, pitch & 0x7f, pitch >> 7 ) )]
+	elif event_type == EventTypes.SYSEX:
+		return [roland_sysex( param1 )]
+
+	return []
+
+# ( seconds, message ) pairs of ( channel, rows ) tracks, merged in time order
+def timed_messages( tracks, ticks_per_beat: int = 48 ):
+	channels, items = merge_tracks( tracks )
+
+	for channel in channels:
+		for message in rpn_messages( channel ):
+			yield ( 0.0, message )
+
+	seconds = 0.0
+	last_time = 0
+	# MIDI default of 120 BPM until the song sets a tempo
+	tempo = 500000
+
+	for channel, row in items:
+		time = row[0]
+		seconds += ( time - last_time ) * tempo / ( ticks_per_beat * 1000000 )
+		last_time = time
+
+		if row[1] == EventTypes.TEMPO:
+			tempo = row[3]
+
+		for message in event_messages( channel, row ):
+			yield ( seconds, message )
+
+#-----------------------------------------------------------
+
+# Playback sink keeping ( seconds since the start, message ) pairs in `messages`
+class RecorderSink:
+	def __init__( self ):
+		self.messages	: List[tuple] = []
+		self.start		= None
+
+	def send( self, message: bytes ) -> None:
+		now = time.perf_counter()
+		if self.start is None:
+			self.start = now
+		self.messages.append( ( now - self.start, message ) )
+
+	def close( self ) -> None:
+		pass
+
+# Playback sink writing raw MIDI bytes to a binary stream, such as a MIDI device node
+class RawSink:
+	def __init__( self, f: BinaryIO ):
+		self.f = f
+
+	def send( self, message: bytes ) -> None:
+		self.f.write( message )
+		self.f.flush()
+
+	def close( self ) -> None:
+		self.f.close()
+
+# Playback sink sending to a mido output port, the default one if no name is given
+class PortSink:
+	def __init__( self, name: str = None ):
+		if import_mido() is None:
+			raise ImportError( 'playing to a MIDI port requires mido' )
+
+		self.port = mido.open_output( name )
+
+	def send( self, message: bytes ) -> None:
+		self.port.send( mido.Message.from_bytes( message ) )
+
+	def close( self ) -> None:
+		self.port.close()
+
+#-----------------------------------------------------------
+
+def lateness_report( lateness: List[float], start_latency: float ) -> dict:
+	ordered = sorted( lateness )
+	count = len( ordered )
+
+	return {
+		'messages'		: count,
+		'start_latency'	: start_latency,
+		'mean'			: sum( ordered ) / count if count else 0.0,
+		'p99'			: ordered[min( count - 1, int( count * 0.99 ) )] if count else 0.0,
+		'max'			: ordered[-1] if count else 0.0,
+	}
+
+# Send ( seconds, message ) pairs to `sink` on time, parsing up to
+# `lookahead` seconds ahead in a thread; returns how late they were
+async def play_messages( messages, sink, lookahead: float = 0.1 ) -> dict:
+	import asyncio
+
+	loop = asyncio.get_running_loop()
+	called = loop.time()
+	queue = collections.deque()
+	ready = asyncio.Event()
+	lateness = []
+	done = False
+	start = None
+
+	def fill( horizon: float ) -> list:
+		batch = []
+
+		for item in messages:
+			batch.append( item )
+			if item[0] > horizon:
+				break
+
+		return batch
+
+	async def produce() -> None:
+		nonlocal done, start
+		horizon = lookahead
+
+		while True:
+			batch = await loop.run_in_executor( None, fill, horizon )
+
+			if not batch:
+				break
+
+			if start is None:
+				start = loop.time()
+
+			queue.extend( batch )
+			ready.set()
+
+			# wait until the clock is within the lookahead window of the last message
+			horizon = batch[-1][0] + lookahead
+			delay = start + batch[-1][0] - lookahead - loop.time()
+
+			if delay > 0:
+				await asyncio.sleep( delay )
+
+		done = True
+		ready.set()
+
+	async def consume() -> None:
+		while True:
+			if not queue:
+				if done:
+					return
+				ready.clear()
+				await ready.wait()
+				continue
+
+			due, message = queue[0]
+			delay = start + due - loop.time()
+
+			if delay > 0:
+				await asyncio.sleep( delay )
+
+			queue.popleft()
+			sink.send( message )
+			lateness.append( max( loop.time() - start - due, 0.0 ) )
+
+	await asyncio.gather( produce(), consume() )
+
+	return lateness_report( lateness, 0.0 if start is None else start - called )
+
+# Play one segment to `sink`, which has send( message ) and close() methods
+def play_song( data, segment: int, sink, options: ConvertOptions = None, lookahead: float = 0.1 ) -> dict:
+	import asyncio
+
+	tracks = iter_song_tracks( data, segment, options, interleave = True )
+	messages = timed_messages( ( track.channel, rows ) for track, rows in tracks )
+
+	# the parser runs in a worker thread; switch threads often enough that
+	# it can't hold up the messages due meanwhile
+	switch_interval = sys.getswitchinterval()
+	sys.setswitchinterval( 0.0005 )
+
+	try:
+		return asyncio.run( play_messages( messages, sink, lookahead ) )
+	except BaseException:
+		# silence anything left sounding when stopped early
+		for channel in range( 16 ):
+			sink.send( bytes( ( 0xb0 | channel, 123, 0 ) ) )
+		raise
+	finally:
+		sys.setswitchinterval( switch_interval )
+		sink.close()
+
+#-----------------------------------------------------------
+
+def segment_arg( value: str ):
+	if value == 'all':
+		return value
+
+	try:
+		segment = int( value )
+	except ValueError:
+		segment = -1
+
+	if not 0 <= segment < 4:
+		raise argparse.ArgumentTypeError( 'expected 0-3 or all, got {}'.format( value ) )
+
+	return segment
+
+def add_convert_arguments( args: argparse.ArgumentParser ) -> None:
+	args.add_argument(
+		'-t', '--translate-drums', action = 'store_true',
+		help = 'translate drum mapping to GS drum mapping' )
+	args.add_argument(
+		'--tempo-fade-step', dest = 'tempo_fade_step',
+		type = int, default = 1, metavar = 'TICKS',
+		help = 'ticks between tempo changes generated for tempo fades (default: 1)' )
+	args.add_argument(
+		'--tempo-fade-bpm', dest = 'tempo_fade_bpm',
+		type = float, default = 0, metavar = 'BPM',
+		help = 'minimum BPM change between tempo changes generated for tempo fades (default: 0)' )
+	args.add_argument(
+		'--ramp-step', dest = 'ramp_step',
+		type = int, default = 1, metavar = 'TICKS',
+		help = 'round the events generated for volume fades to multiples of TICKS (default: 1)' )
+	args.add_argument(
+		'--ramp-threshold', dest = 'ramp_threshold',
+		type = int, default = 1, metavar = 'N',
+		help = 'minimum volume change between events generated for volume fades (default: 1)' )
+	args.add_argument(
+		'--tremolo', action = 'store_true',
+		help = 'write tremolo as modulation (CC 1) reaching its depth after its delay' )
+
+	args.add_argument(
+		'--unroll', dest = 'unroll',
+		type = int, default = 1, metavar = 'N',
+		help = 'play loop bodies N times before the looping copy (default: 1)' )
+	args.add_argument(
+		'--loop-cc111', dest = 'loop_cc111', action = 'store_true',
+		help = 'also mark loop starts with CC 111' )
+	args.add_argument(
+		'--format', dest = 'smf_format',
+		type = int, choices = ( 0, 1 ), default = 1,
+		help = 'MIDI file format: 0 merges all channels into one track (default: 1)' )
+	args.add_argument(
+		'--optimize', action = 'store_true',
+		help = 'drop events that change nothing, such as repeated controller values' )
+
+def options_from_args( args: argparse.Namespace ) -> ConvertOptions:
+	return ConvertOptions(
+		args.translate_drums, args.tempo_fade_step, args.tempo_fade_bpm, args.unroll, args.loop_cc111,
+		args.smf_format, args.optimize, args.ramp_step, args.ramp_threshold, args.tremolo )
+
+def add_cache_arguments( args: argparse.ArgumentParser ) -> None:
+	args.add_argument(
+		'--cache-dir', dest = 'cache_dir',
+		help = 'reuse converted MIDI files stored in this directory' )
+	args.add_argument(
+		'--cache-size', dest = 'cache_size',
+		type = int, default = 256, metavar = 'MB',
+		help = 'maximum size of the cache directory (default: 256)' )
+
+def cache_from_args( args: argparse.Namespace ) -> ConversionCache:
+	if args.cache_dir is None:
+		return None
+
+	return ConversionCache( args.cache_dir, args.cache_size << 20 )
+
+def print_cache_stats( hits: int, misses: int ) -> None:
+	print( 'Cache: {:d} hits, {:d} misses'.format( hits, misses ) )
+
+def print_removed( removed: List[int] ) -> None:
+	counts = ', '.join( '{} {:d}'.format( event_type.name, removed[event_type] )
+		for event_type in EventTypes if removed[event_type] != 0 )
+	print( 'Removed {:d} redundant events{}'.format( sum( removed ), ': ' + counts if counts else '' ) )
+
+def add_index_dir_argument( args: argparse.ArgumentParser ) -> None:
+	args.add_argument(
+		'--index-dir', dest = 'index_dir',
+		help = 'directory for cached archive indexes (default: ~/.cache/pm64-to-midi)' )
+
+def add_input_arguments( args: argparse.ArgumentParser, required: bool = True ) -> None:
+	args.add_argument(
+		'-i', '--in', dest = 'in_file',
+		help = 'BGM file, SBN archive or ROM image name', required = required )
+	args.add_argument(
+		'--song', dest = 'song',
+		help = 'name or index of the song to use from an SBN archive or ROM image' )
+	add_index_dir_argument( args )
+
+# the BGM file name, or a BgmReader for the song picked from an SBN archive or ROM image
+def open_input( arg_parser: argparse.ArgumentParser, args: argparse.Namespace ):
+	if not BgmArchive.is_archive( args.in_file ):
+		if args.song is not None:
+			arg_parser.error( '--song needs an SBN archive or ROM image' )
+		return args.in_file
+
+	if args.song is None:
+		arg_parser.error( '--song is required to use an SBN archive or ROM image' )
+
+	archive = BgmArchive( args.in_file, args.index_dir )
+	return archive.reader( archive.find( args.song ) )
+
+#-----------------------------------------------------------
+
+def batch_job( job: tuple ) -> tuple:
+	in_file, segment, out_file, options, cache = job
+
+	try:
+		out_dir = os.path.dirname( out_file )
+		if out_dir:
+			os.makedirs( out_dir, exist_ok = True )
+
+		parser = Parser( options )
+		hit = convert_file( in_file, segment, out_file, options, cache, parser = parser )
+	except BgmFormatError as e:
+		return ( in_file, segment, str( e ), False, None )
+	except Exception as e:
+		return ( in_file, segment, '{}: {}'.format( type( e ).__name__, e ), False, None )
+
+	return ( in_file, segment, None, hit, parser.removed )
+
+#-----------------------------------------------------------
+
+# ( bgm_files, errors ) for the files, directories and glob patterns in
+# `inputs`. Files named there that can't be read or aren't BGM files are
+# listed in errors as ( path, message ); those found otherwise are skipped
+def find_bgm_files( inputs: List[str] ) -> tuple:
+	# whether each file was named in `inputs`
+	files = {}
+
+	for pattern in inputs:
+		named = not glob.has_magic( pattern )
+		paths = [pattern] if named else glob.glob( pattern )
+
+		for path in sorted( paths ):
+			if os.path.isdir( path ):
+				for name in sorted( os.listdir( path ) ):
+					if os.path.isfile( os.path.join( path, name ) ):
+						files.setdefault( os.path.join( path, name ), False )
+			else:
+				files[path] = files.get( path, False ) or named
+
+	bgm_files = []
+	errors = []
+
+	for path, named in files.items():
+		try:
+			with open( path, 'rb' ) as f:
+				is_bgm = f.read( 4 ) == b'BGM '
+		except OSError as e:
+			if named:
+				errors.append( ( path, e.strerror ) )
+			else:
+				print( 'Skipping {}: {}'.format( path, e.strerror ) )
+			continue
+
+		if is_bgm:
+			bgm_files.append( path )
+		elif named:
+			errors.append( ( path, 'not a BGM file' ) )
+
+	return bgm_files, errors
+
+#-----------------------------------------------------------
+
+def batch_main( argv: List[str] ) -> None:
+	args = argparse.ArgumentParser( prog = 'pm64_to_midi.py batch' )
+
+	add_convert_arguments( args )
+	add_cache_arguments( args )
+	args.add_argument(
+		'-j', '--jobs', dest = 'jobs',
+		type = int, default = os.cpu_count(),
+		help = 'number of worker processes (default: CPU count)' )
+	args.add_argument(
+		'-o', '--out', dest = 'out_template', default = '{stem}_{segment}.mid',
+		help = 'output name template; may use {stem}, {name}, {dir} and {segment} '
+			'(default: {stem}_{segment}.mid)' )
+	args.add_argument(
+		'inputs', nargs = '+',
+		help = 'BGM files, directories or glob patterns' )
+
+	args = args.parse_args( argv )
+
+	options = options_from_args( args )
+	cache = cache_from_args( args )
+	in_files, errors = find_bgm_files( args.inputs )
+	jobs = []
+
+	for in_file in in_files:
+		reader = BgmReader.open( in_file )
+		stem = os.path.splitext( os.path.basename( in_file ) )[0]
+
+		for segment in get_segments( reader ):
+			out_file = args.out_template.format(
+				stem = stem, name = os.path.basename( in_file ),
+				dir = os.path.dirname( in_file ), segment = segment )
+			jobs.append( ( in_file, segment, out_file, options, cache ) )
+
+	if args.jobs <= 1:
+		results = [batch_job( job ) for job in jobs]
+	else:
+		import concurrent.futures
+
+		with concurrent.futures.ProcessPoolExecutor( max_workers = args.jobs ) as pool:
+			results = list( pool.map( batch_job, jobs, chunksize = 4 ) )
+
+	failures = [r for r in results if r[2] is not None]
+
+	print( 'Converted {:d} of {:d} segments'.format( len( results ) - len( failures ), len( results ) ) )
+
+	if cache is not None:
+		hits = sum( 1 for r in results if r[3] )
+		print_cache_stats( hits, len( results ) - len( failures ) - hits )
+
+	if options.optimize:
+		removed = [0] * len( EventTypes )
+
+		for result in results:
+			if result[4] is not None:
+				removed = [a + b for a, b in zip( removed, result[4] )]
+
+		print_removed( removed )
+
+	for in_file, error in errors:
+		print( 'FAILED {}: {}'.format( in_file, error ) )
+
+	for in_file, segment, error, hit, removed in failures:
+		print( 'FAILED {} segment {:d}: {}'.format( in_file, segment, error ) )
+
+	if errors or failures:
+		sys.exit( 1 )
+
+#-----------------------------------------------------------
+
+def play_main( argv: List[str] ) -> None:
+	args = argparse.ArgumentParser( prog = 'pm64_to_midi.py play' )
+
+	add_convert_arguments( args )
+	add_input_arguments( args )
+	args.add_argument(
+		'-s', '--segment', dest = 'segment',
+		type = segment_arg,
+		help = 'segment ID (0-3)', required = True )
+	args.add_argument(
+		'--port', dest = 'port',
+		help = 'MIDI output port to play to (default: the system default)' )
+	args.add_argument(
+		'--raw', dest = 'raw_file', metavar = 'FILE',
+		help = 'write raw MIDI bytes to FILE, e.g. a MIDI device node, or - for stdout' )
+	args.add_argument(
+		'--list-ports', action = 'store_true',
+		help = 'list the MIDI output ports' )
+	args.add_argument(
+		'--lookahead', dest = 'lookahead',
+		type = float, default = 100, metavar = 'MS',
+		help = 'how far ahead of the clock events are parsed (default: 100)' )
+
+	parsed = args.parse_args( argv )
+
+	if parsed.list_ports:
+		if import_mido() is None:
+			sys.exit( 'Listing MIDI ports requires mido' )
+
+		for name in mido.get_output_names():
+			print( name )
+		return
+
+	if parsed.segment == 'all':
+		args.error( 'only one segment can be played at a time; choose one of 0-3' )
+
+	in_file = open_input( args, parsed )
+	reader = in_file if isinstance( in_file, BgmReader ) else BgmReader.open( in_file )
+	report_file = sys.stdout
+
+	if parsed.raw_file == '-':
+		sink = RawSink( sys.stdout.buffer )
+		report_file = sys.stderr
+	elif parsed.raw_file is not None:
+		sink = RawSink( open( parsed.raw_file, 'wb' ) )
+	else:
+		try:
+			sink = PortSink( parsed.port )
+		except ImportError as e:
+			sys.exit( '{}; use --raw to write MIDI bytes instead'.format( e ) )
+
+	try:
+		report = play_song( reader, parsed.segment, sink, options_from_args( parsed ), parsed.lookahead / 1000 )
+	except KeyboardInterrupt:
+		# Ctrl+C is how playback is stopped; play_song has already silenced the sink
+		sys.exit( 130 )
+
+	print( 'Played {:d} messages; the first one after {:.1f} ms'.format(
+		report['messages'], report['start_latency'] * 1000 ), file = report_file )
+	print( 'Lateness: mean {:.2f} ms, 99th percentile {:.2f} ms, max {:.2f} ms'.format(
+		report['mean'] * 1000, report['p99'] * 1000, report['max'] * 1000 ), file = report_file )
+
+#-----------------------------------------------------------
+
+def inspect_main( argv: List[str] ) -> None:
+	args = argparse.ArgumentParser( prog = 'pm64_to_midi.py inspect' )
+
+	args.add_argument(
+		'-o', '--out', dest = 'out_file',
+		help = 'write the report, one JSON object per song, to this file instead of stdout' )
+	add_index_dir_argument( args )
+	args.add_argument(
+		'inputs', nargs = '+',
+		help = 'BGM files, directories or glob patterns, or SBN archives or ROM images' )
+
+	args = args.parse_args( argv )
+
+	reports = []
+	patterns = []
+
+	def add_report( report: dict, open_song ) -> None:
+		# like in batch mode, a song that can't be read is reported and the run goes on
+		try:
+			report.update( inspect_song( open_song() ) )
+		except BgmFormatError as e:
+			report['error'] = str( e )
+		except Exception as e:
+			report['error'] = '{}: {}'.format( type( e ).__name__, e )
+
+		reports.append( report )
+
+	# archives given by name are inspected song by song; the rest are found as in batch mode
+	for path in args.inputs:
+		if os.path.isfile( path ) and BgmArchive.is_archive( path ):
+			try:
+				archive = BgmArchive( path, args.index_dir )
+			except BgmFormatError as e:
+				reports.append( { 'file': path, 'error': str( e ) } )
+				continue
+
+			for entry in archive.entries:
+				add_report( { 'file': path, 'song': entry[0] }, lambda: archive.reader( entry ) )
+		else:
+			patterns.append( path )
+
+	if patterns:
+		in_files, errors = find_bgm_files( patterns )
+
+		for in_file, error in errors:
+			reports.append( { 'file': in_file, 'error': error } )
+
+		for in_file in in_files:
+			add_report( { 'file': in_file }, lambda: BgmReader.open( in_file ) )
+
+	# one song per line, so large directories can be filtered line by line
+	f = open( args.out_file, 'w' ) if args.out_file is not None else sys.stdout
+
+	try:
+		for report in reports:
+			f.write( json.dumps( report ) + '\n' )
+	finally:
+		if f is not sys.stdout:
+			f.close()
+
+	# like a validator, fail if anything is wrong with any of the songs
+	if any( report.get( 'issues' ) or 'error' in report for report in reports ):
+		sys.exit( 1 )
+
+#-----------------------------------------------------------
+
+# Answers serve mode requests, keeping songs open with their EX tables
+# loaded until they change on disk
+class ConvertServer:
+	MAX_SONGS = 64
+
+	def __init__( self, options: ConvertOptions, cache: ConversionCache = None, index_dir: str = None ):
+		self.options	= options
+		self.cache		= cache
+		self.index_dir	= index_dir
+		# ( path, song ) -> ( size, mtime, reader, parser holding the EX tables ),
+		# least recently used first
+		self.songs		= collections.OrderedDict()
+
+	# a reader, and a parser holding the EX tables, for a BGM file or a song in an archive
+	def open_song( self, path: str, song: str = None ) -> tuple:
+		stat = os.stat( path )
+		key = ( os.path.abspath( path ), song )
+		entry = self.songs.get( key )
+
+		if entry is None or entry[:2] != ( stat.st_size, stat.st_mtime_ns ):
+			if song is not None:
+				archive = BgmArchive( path, self.index_dir )
+				reader = archive.reader( archive.find( song ) )
+			elif BgmArchive.is_archive( path ):
+				raise ValueError( '"song" is required to use an SBN archive or ROM image' )
+			else:
+				reader = BgmReader.open( path )
+
+			parser = Parser( self.options )
+			load_tables( reader, parser )
+			entry = self.songs[key] = ( stat.st_size, stat.st_mtime_ns, reader, parser )
+
+			if len( self.songs ) > self.MAX_SONGS:
+				self.songs.popitem( last = False )
+
+		self.songs.move_to_end( key )
+		return entry[2], entry[3]
+
+	def convert( self, request: dict ) -> dict:
+		options = ConvertOptions( **dict( vars( self.options ), **request.get( 'options', {} ) ) )
+		segment = request.get( 'segment' )
+		out_file = request.get( 'out' )
+
+		if segment != 'all' and segment not in range( 4 ):
+			raise ValueError( '"segment" must be 0-3 or "all"' )
+
+		if 'data' in request:
+			reader = BgmReader( base64.b64decode( request['data'] ) )
+			parser = Parser( options )
+		elif 'in' in request:
+			reader, tables = self.open_song( request['in'], request.get( 'song' ) )
+			parser = tables.fork( options )
+		else:
+			raise ValueError( 'no input; give "in" or "data"' )
+
+		if segment == 'all':
+			if out_file is None:
+				raise ValueError( '"out" is required to convert all segments' )
+
+			segments = convert_all_segments( reader, out_file, options, self.cache, chain = request.get( 'chain', False ),
+				parser = parser )
+			return { 'segments': segments }
+
+		if out_file is None:
+			f = io.BytesIO()
+			convert_to_stream( reader, segment, f, options, parser = parser )
+			return { 'midi': base64.b64encode( f.getvalue() ).decode( 'ascii' ) }
+
+		return { 'cached': convert_file( reader, segment, out_file, options, self.cache, parser = parser ) }
+
+	# Answer one request line with its id, status, time taken and any error
+	def handle( self, line ) -> dict:
+		start = time.perf_counter()
+		response = {}
+
+		try:
+			request = json.loads( line )
+
+			if not isinstance( request, dict ):
+				raise ValueError( 'requests must be JSON objects' )
+
+			response['id'] = request.get( 'id' )
+			response.update( self.convert( request ) )
+			response['status'] = 'ok'
+		except BgmFormatError as e:
+			response.update( status = 'error', error = str( e ) )
+		except Exception as e:
+			response.update( status = 'error', error = '{}: {}'.format( type( e ).__name__, e ) )
+
+		response['seconds'] = time.perf_counter() - start
+		return response
+
+def is_socket( path: str ) -> bool:
+	from stat import S_ISSOCK
+
+	try:
+		return S_ISSOCK( os.stat( path ).st_mode )
+	except OSError:
+		return False
+
+# Answer requests from any number of clients of a UNIX socket, one conversion at a time
+async def serve_socket( server: ConvertServer, path: str ) -> None:
+	import asyncio
+
+	async def client( reader, writer ) -> None:
+		try:
+			while True:
+				line = await reader.readline()
+
+				if not line:
+					break
+
+				if line.strip():
+					writer.write( ( json.dumps( server.handle( line ) ) + '\n' ).encode() )
+					await writer.drain()
+		finally:
+			writer.close()
+
+	# a socket left behind by a server that didn't shut down cleanly would block binding
+	if is_socket( path ):
+		os.remove( path )
+
+	# lines carrying a song as base64 can be much longer than the default limit
+	listener = await asyncio.start_unix_server( client, path, limit = 64 << 20 )
+
+	async with listener:
+		await listener.serve_forever()
+
+#-----------------------------------------------------------
+
+def serve_main( argv: List[str] ) -> None:
+	args = argparse.ArgumentParser( prog = 'pm64_to_midi.py serve' )
+
+	add_convert_arguments( args )
+	add_cache_arguments( args )
+	args.add_argument(
+		'--socket', dest = 'socket',
+		help = 'listen on this UNIX socket instead of reading requests from stdin' )
+	add_index_dir_argument( args )
+
+	args = args.parse_args( argv )
+
+	server = ConvertServer( options_from_args( args ), cache_from_args( args ), args.index_dir )
+
+	if args.socket is not None:
+		import asyncio, signal
+
+		# stop the same way when terminated as when interrupted
+		signal.signal( signal.SIGTERM, signal.default_int_handler )
+
+		try:
+			asyncio.run( serve_socket( server, args.socket ) )
+		except KeyboardInterrupt:
+			pass
+		finally:
+			if is_socket( args.socket ):
+				os.remove( args.socket )
+		return
+
+	for line in sys.stdin:
+		if line.strip():
+			sys.stdout.write( json.dumps( server.handle( line ) ) + '\n' )
+			sys.stdout.flush()
+
+#-----------------------------------------------------------
+
+def convert_main( argv: List[str] ) -> None:
+	args = argparse.ArgumentParser()
+
+	add_convert_arguments( args )
+	add_cache_arguments( args )
+	add_input_arguments( args, required = False )
+	args.add_argument(
+		'-s', '--segment', dest = 'segment',
+		type = segment_arg,
+		help = 'segment ID (0-3), or all to convert every segment' )
+	args.add_argument(
+		'-o', '--out', dest = 'out_file',
+		help = 'MIDI file name; with -s all, {segment} in it or a _N suffix names each file' )
+	args.add_argument(
+		'--chain', action = 'store_true',
+		help = 'with -s all, write the segments one after another into a single file' )
+	args.add_argument(
+		'-j', '--jobs', dest = 'jobs',
+		type = int, default = 1,
+		help = 'parse the tracks of each segment in this many processes (default: 1)' )
+	args.add_argument(
+		'--list', action = 'store_true',
+		help = 'list the songs in an SBN archive or ROM image' )
+	args.add_argument(
+		'--stats', action = 'store_true',
+		help = 'print phase timings, opcode counts and the memory peak' )
+	args.add_argument(
+		'--stats-json', dest = 'stats_json', metavar = 'FILE',
+		help = 'write the --stats numbers to a JSON file' )
+	args.add_argument(
+		'--dump-ir', dest = 'dump_ir', metavar = 'FILE',
+		help = 'write the parsed events to an IR file, named like -o with -s all; -o is then optional' )
+	args.add_argument(
+		'--from-ir', dest = 'from_ir', metavar = 'FILE',
+		help = 'write the MIDI file from an IR file instead of a BGM; only --optimize and --format apply' )
+
+	parsed = args.parse_args( argv )
+
+	if parsed.from_ir is not None:
+		if parsed.in_file is not None or parsed.dump_ir is not None:
+			args.error( '--from-ir cannot be combined with -i/--in or --dump-ir' )
+
+		if parsed.jobs != 1 or parsed.cache_dir is not None:
+			args.error( '--from-ir cannot be combined with -j/--jobs or --cache-dir' )
+
+		if parsed.out_file is None:
+			args.error( 'the following arguments are required: -o/--out' )
+
+		try:
+			ir = IrFile( parsed.from_ir )
+		except ( OSError, ValueError ) as e:
+			args.error( str( e ) )
+
+		options = options_from_args( parsed )
+		removed = [0] * len( EventTypes )
+
+		with open( parsed.out_file, 'wb' ) as f:
+			convert_ir( ir, f, options, removed )
+
+		if options.optimize:
+			print_removed( removed )
+		return
+
+	if parsed.in_file is None:
+		args.error( 'the following arguments are required: -i/--in' )
+
+	if parsed.list:
+		if not BgmArchive.is_archive( parsed.in_file ):
+			args.error( '--list needs an SBN archive or ROM image' )
+
+		BgmArchive( parsed.in_file, parsed.index_dir ).print_list()
+		return
+
+	if parsed.segment is None or ( parsed.out_file is None and parsed.dump_ir is None ):
+		args.error( 'the following arguments are required: -s/--segment, -o/--out' )
+
+	if parsed.dump_ir is not None and ( parsed.chain or parsed.stats or parsed.stats_json is not None or
+		parsed.jobs != 1 or parsed.cache_dir is not None ):
+		args.error( '--dump-ir cannot be combined with --chain, --stats, -j/--jobs or --cache-dir' )
+
+	in_file = open_input( args, parsed )
+	args = parsed
+	cache = cache_from_args( args )
+	stats = ConvertStats() if args.stats or args.stats_json is not None else None
+
+	options = options_from_args( args )
+	parser = Parser( options )
+
+	if args.dump_ir is not None:
+		dump_ir_files( in_file, args.segment, args.dump_ir, args.out_file, options, parser )
+	elif args.segment == 'all':
+		convert_all_segments( in_file, args.out_file, options, cache, stats, args.chain, parser, args.jobs )
+	else:
+		convert_file( in_file, args.segment, args.out_file, options, cache, stats, parser, args.jobs )
+
+	if cache is not None:
+		print_cache_stats( cache.hits, cache.misses )
+
+	if options.optimize:
+		print_removed( parser.removed )
+
+	if args.stats:
+		stats.report()
+
+	if args.stats_json is not None:
+		with open( args.stats_json, 'w' ) as f:
+			json.dump( stats.to_dict(), f, indent = '\t' )
+
+#-----------------------------------------------------------
+
+default_formatwarning = warnings.formatwarning
+
+def format_warning( message, category, filename, lineno, line = None ) -> str:
+	# warnings about the song are for the user; leave out where they were raised
+	if issubclass( category, BgmWarning ):
+		return '{}\n'.format( message )
+
+	return default_formatwarning( message, category, filename, lineno, line )
+
+def main():
+	warnings.formatwarning = format_warning
+	commands = { 'batch': batch_main, 'play': play_main, 'inspect': inspect_main, 'serve': serve_main }
+
+	try:
+		if len( sys.argv ) > 1 and sys.argv[1] in commands:
+			commands[sys.argv[1]]( sys.argv[2:] )
+		else:
+			convert_main( sys.argv[1:] )
+	except BgmFormatError as e:
+		sys.exit( str( e ) )
 
 #-----------------------------------------------------------
 
@@ -0,0 +1,143 @@
+# Builds small BGM files command by command for the tests, and decodes the
+# Standard MIDI Files written from them.
+
+import struct
+
+#-----------------------------------------------------------
+
+# detour phrases are placed from here on, right after the BGMFileInfo
+PHRASE_BASE = 0x24
+
+def note( key: int, velocity: int = 100, length: int = 10 ) -> bytes:
+	return bytes( ( 0x80 | key, velocity, length ) )
+
+def delta( ticks: int ) -> bytes:
+	return bytes( ( ticks, ) )
+
+def cmd( opcode: int, fmt: str = '', *args ) -> bytes:
+	return bytes( ( opcode, ) ) + struct.pack( '>' + fmt, *args )
+
+def tempo( bpm: int ) -> bytes:
+	return cmd( 0xe0, 'H', bpm )
+
+def tempo_fade( duration: int, bpm: int ) -> bytes:
+	return cmd( 0xe4, 'HH', duration, bpm )
+
+def detour( target: int, length: int ) -> bytes:
+	return cmd( 0xfe, 'HB', target, length )
+
+def jump( table: int, count: int = 1 ) -> bytes:
+	return cmd( 0xfc, 'HB', table, count )
+
+def phrase_offsets( phrases ) -> list:
+	offsets = []
+	pos = PHRASE_BASE
+
+	for phrase in phrases:
+		offsets.append( pos )
+		pos += len( phrase )
+
+	return offsets
+
+def pad4( data: bytearray ) -> None:
+	while len( data ) % 4:
+		data.append( 0 )
+
+# segment 0 plays one subsegment `plays` times, or with `copies` a copy of it
+# each time. `tracks` holds the commands of each channel's track, or None, and
+# `phrases` are placed at phrase_offsets
+def make_bgm( tracks, phrases = (), drum_channels = (), plays: int = 1, copies: bool = False ) -> bytes:
+	data = bytearray( b'BGM ' + bytes( 4 ) + b'TEST' + bytes( PHRASE_BASE - 12 ) )
+
+	for phrase in phrases:
+		data += phrase
+
+	pad4( data )
+	seg_ofs = len( data )
+	data[0x14:0x16] = struct.pack( '>H', seg_ofs >> 2 )
+	data += bytes( 4 * ( plays + 1 ) )
+
+	for i in range( plays ):
+		if i == 0 or copies:
+			pad4( data )
+			sub_ofs = len( data )
+			data += bytes( 64 )
+
+			for channel, body in enumerate( tracks ):
+				if body is None:
+					continue
+
+				struct.pack_into( '>HH', data, sub_ofs + channel * 4, len( data ) - sub_ofs,
+					0x80 if channel in drum_channels else 0 )
+				data += body + b'\0'
+
+		struct.pack_into( '>HH', data, seg_ofs + i * 4, 0x3000, ( sub_ofs - seg_ofs ) >> 2 )
+
+	return bytes( data )
+
+# the offsets of the tracks of the first subsegment segment 0 plays
+def track_offsets( data: bytes ) -> list:
+	seg_ofs = struct.unpack_from( '>H', data, 0x14 )[0] << 2
+	sub_ofs = seg_ofs + ( struct.unpack_from( '>H', data, seg_ofs + 2 )[0] << 2 )
+
+	return [sub_ofs + struct.unpack_from( '>H', data, sub_ofs + channel * 4 )[0] for channel in range( 16 )]
+
+#-----------------------------------------------------------
+
+def read_vlq( data: bytes, pos: int ) -> tuple:
+	value = 0
+
+	while True:
+		byte = data[pos]
+		pos += 1
+		value = ( value << 7 ) | ( byte & 0x7f )
+
+		if byte < 0x80:
+			return value, pos
+
+# ( tick, event bytes ) pairs of an MTrk chunk body, with running status filled in
+def read_track( data: bytes ) -> list:
+	events = []
+	pos = 0
+	tick = 0
+	status = None
+
+	while pos < len( data ):
+		ticks, pos = read_vlq( data, pos )
+		tick += ticks
+		start = pos
+
+		if data[pos] == 0xff:
+			length, pos = read_vlq( data, pos + 2 )
+			pos += length
+		elif data[pos] == 0xf0:
+			length, pos = read_vlq( data, pos + 1 )
+			pos += length
+		else:
+			if data[pos] & 0x80:
+				status = data[pos]
+				pos += 1
+
+			size = 1 if ( status & 0xf0 ) in ( 0xc0, 0xd0 ) else 2
+			events.append( ( tick, bytes( ( status, ) ) + bytes( data[pos:pos + size] ) ) )
+			pos += size
+			continue
+
+		events.append( ( tick, bytes( data[start:pos] ) ) )
+
+	return events
+
+# the format of a Standard MIDI File and the read_track events of each track
+def read_smf( data: bytes ) -> tuple:
+	assert data[:4] == b'MThd'
+	smf_format, count = struct.unpack_from( '>HH', data, 8 )
+	pos = 14
+	tracks = []
+
+	for i in range( count ):
+		assert data[pos:pos + 4] == b'MTrk'
+		length, = struct.unpack_from( '>L', data, pos + 4 )
+		tracks.append( read_track( data[pos + 8:pos + 8 + length] ) )
+		pos += 8 + length
+
+	return smf_format, tracks
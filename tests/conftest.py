@@ -0,0 +1,6 @@
+import os, sys
+
+# the tests import the converter, and the synthetic BGM generator of the benchmarks
+root = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' )
+sys.path.insert( 0, root )
+sys.path.insert( 0, os.path.join( root, 'benchmarks' ) )
@@ -0,0 +1,32 @@
+import pytest
+
+from pm64_to_midi import batch_main
+from bgm_builder import delta, make_bgm, note
+
+#-----------------------------------------------------------
+
+def batch_args( tmp_path ) -> list:
+	return ['-j', '1', '-o', str( tmp_path / 'out' / '{stem}_{segment}.mid' )]
+
+def test_named_files_that_are_not_bgms_fail( tmp_path, capsys ):
+	( tmp_path / 'song.bgm' ).write_bytes( make_bgm( [note( 60 ) + delta( 10 )] ) )
+	( tmp_path / 'notes.txt' ).write_text( 'not a song' )
+	inputs = [str( tmp_path / name ) for name in ( 'song.bgm', 'notes.txt', 'missing.bgm' )]
+
+	with pytest.raises( SystemExit ) as e:
+		batch_main( batch_args( tmp_path ) + inputs )
+
+	assert e.value.code == 1
+	assert capsys.readouterr().out.splitlines() == [
+		'Converted 1 of 1 segments',
+		'FAILED {}: not a BGM file'.format( inputs[1] ),
+		'FAILED {}: No such file or directory'.format( inputs[2] )]
+	assert ( tmp_path / 'out' / 'song_0.mid' ).exists()
+
+def test_directory_scan_skips_other_files( tmp_path, capsys ):
+	( tmp_path / 'song.bgm' ).write_bytes( make_bgm( [note( 60 ) + delta( 10 )] ) )
+	( tmp_path / 'notes.txt' ).write_text( 'not a song' )
+
+	batch_main( batch_args( tmp_path ) + [str( tmp_path )] )
+
+	assert capsys.readouterr().out.splitlines() == ['Converted 1 of 1 segments']
@@ -0,0 +1,273 @@
+import io, struct
+import pytest
+
+import pm64_to_midi
+from pm64_to_midi import ( BgmReader, ConvertOptions, ConvertStats, EventTypes, IrFile, bpm_to_tempo, convert,
+	convert_ir, convert_to_bytes, convert_to_stream, dump_ir, parse_song, track2smf )
+from bgm_builder import ( cmd, delta, detour, jump, make_bgm, note, phrase_offsets, read_smf, read_track, tempo,
+	tempo_fade, track_offsets )
+import synth_bgm
+
+#-----------------------------------------------------------
+
+def track_rows( data: bytes, channel: int = 0, options: ConvertOptions = None ) -> list:
+	return list( parse_song( data, 0, options ).tracks[channel].events.rows() )
+
+def note_ons( rows ) -> list:
+	return [( row[0], row[3] ) for row in rows if row[1] == EventTypes.NOTE_ON]
+
+def tempos( rows ) -> list:
+	return [( row[0], row[3] ) for row in rows if row[1] == EventTypes.TEMPO]
+
+#-----------------------------------------------------------
+# detours
+
+def test_reader_nested_detour_resumes_enclosing_one():
+	reader = BgmReader( bytes( range( 16 ) ) )
+	read = [reader.next_byte()]
+
+	reader.detour( 8, 3 )
+	read.append( reader.next_byte() )
+
+	# the inner detour returns to the outer one, which still has two bytes left
+	reader.detour( 12, 1 )
+	read += [reader.next_byte() for i in range( 4 )]
+
+	assert read == [0, 8, 12, 9, 10, 1]
+
+def test_nested_detour_returns_to_enclosing_phrase():
+	inner = note( 62 ) + delta( 10 )
+	inner_ofs, outer_ofs = phrase_offsets( [inner, bytes( 12 )] )
+	# the operands of the nested detour don't count against the outer one
+	outer = note( 61 ) + delta( 10 ) + detour( inner_ofs, len( inner ) ) + note( 63 ) + delta( 10 )
+	track = note( 60 ) + delta( 10 ) + detour( outer_ofs, len( outer ) - 3 ) + note( 64 ) + delta( 10 )
+
+	rows = track_rows( make_bgm( [track], [inner, outer] ) )
+
+	assert note_ons( rows ) == [( 0, 60 ), ( 10, 61 ), ( 20, 62 ), ( 30, 63 ), ( 40, 64 )]
+
+def test_repeated_detour_matches_first_play():
+	phrase = note( 61 ) + delta( 5 ) + note( 62 ) + delta( 5 )
+	phrase_ofs, = phrase_offsets( [phrase] )
+	track = ( detour( phrase_ofs, len( phrase ) ) + note( 60 ) + delta( 3 ) ) * 3
+
+	rows = track_rows( make_bgm( [track], [phrase] ) )
+
+	assert note_ons( rows ) == [( 0, 61 ), ( 5, 62 ), ( 10, 60 ), ( 13, 61 ), ( 18, 62 ), ( 23, 60 ),
+		( 26, 61 ), ( 31, 62 ), ( 36, 60 )]
+
+def test_reused_subsegment_and_phrase_match_uncached( monkeypatch ):
+	phrase = cmd( 0xef, 'h', 50 ) + note( 62 ) + delta( 10 )
+	drum_phrase = note( 28 ) + delta( 10 )
+	phrase_ofs, drum_phrase_ofs = phrase_offsets( [phrase, drum_phrase] )
+	tracks = [
+		# the coarse tuning set at the end changes the phrase's pitch bend on later plays
+		detour( phrase_ofs, len( phrase ) ) + note( 60 ) + delta( 10 ) + cmd( 0xed, 'b', 2 ),
+		# later plays start in drum mode, with the patch of both drums already set
+		detour( drum_phrase_ofs, len( drum_phrase ) ) + note( 29 ) + delta( 10 ),
+	]
+	options = ConvertOptions( translate_drums = True )
+
+	cached = convert_to_bytes( make_bgm( tracks, [phrase, drum_phrase], drum_channels = [1], plays = 3 ), 0, options )
+
+	# copies of the subsegment aren't reused, and phrases without a scan are followed byte by byte
+	monkeypatch.setattr( pm64_to_midi, 'scan_phrase', lambda *args: None )
+	copied = make_bgm( tracks, [phrase, drum_phrase], drum_channels = [1], plays = 3, copies = True )
+
+	assert cached == convert_to_bytes( copied, 0, options )
+
+#-----------------------------------------------------------
+# loops
+
+# `start` followed by `body` in a loop
+def loop_song( start: bytes, body: bytes ) -> bytes:
+	table_ofs, = phrase_offsets( [bytes( 4 )] )
+	track = start + body + jump( table_ofs )
+
+	# the jump table's only entry points back at the start of the body
+	data = bytearray( make_bgm( [track], [bytes( 4 )] ) )
+	struct.pack_into( '>H', data, table_ofs, track_offsets( data )[0] + len( start ) )
+
+	return bytes( data )
+
+@pytest.mark.parametrize( 'unroll', ( 1, 3 ) )
+def test_loop_is_marked_around_last_copy( unroll ):
+	data = loop_song( note( 60 ) + delta( 10 ), note( 62 ) + delta( 10 ) + note( 64 ) + delta( 10 ) )
+
+	smf_format, tracks = read_smf( convert_to_bytes( data, 0, ConvertOptions( unroll = unroll ) ) )
+	markers = [( time, event[3:].decode() ) for time, event in tracks[0] if event[:2] == b'\xff\x06']
+	notes = [( time, event[1] ) for time, event in tracks[0] if event[0] & 0xf0 == 0x90]
+	end = 10 + 20 * unroll
+
+	assert markers == [( end - 20, 'loopStart' ), ( end, 'loopEnd' )]
+	assert notes == [( 0, 60 )] + [( 10 + 20 * i + time, key )
+		for i in range( unroll ) for time, key in ( ( 0, 62 ), ( 10, 64 ) )]
+
+#-----------------------------------------------------------
+# optimize
+
+def test_optimize_keeps_repeated_cc_after_loop_start():
+	pan = cmd( 0xea, 'B', 64 )
+	data = loop_song( pan + note( 60 ) + delta( 5 ) + pan + delta( 5 ), pan + note( 62 ) + delta( 10 ) )
+
+	events = read_smf( convert_to_bytes( data, 0, ConvertOptions( optimize = True ) ) )[1][0]
+
+	# the loop may be entered with another pan, so only the repeat at tick 5 goes
+	assert [time for time, event in events if event == bytes( ( 0xb0, 10, 64 ) )] == [0, 10]
+
+def test_optimize_drops_tempo_change_only_when_overridden():
+	track = tempo( 120 ) + tempo( 130 ) + note( 60 ) + delta( 10 ) + tempo( 130 ) + note( 62 ) + delta( 10 )
+
+	events = read_smf( convert_to_bytes( make_bgm( [track] ), 0, ConvertOptions( optimize = True ) ) )[1][0]
+
+	# other tracks may change the tempo in between, so the repeat at tick 10 stays
+	assert [( time, event[3:] ) for time, event in events if event[:2] == b'\xff\x51'] == [
+		( 0, bpm_to_tempo( 130 ).to_bytes( 3, 'big' ) ), ( 10, bpm_to_tempo( 130 ).to_bytes( 3, 'big' ) )]
+
+#-----------------------------------------------------------
+# tempo fades
+
+def test_tempo_fade_ramps_towards_target():
+	track = tempo( 120 ) + tempo_fade( 8, 160 ) + delta( 20 ) + tempo( 100 ) + note( 60 )
+
+	rows = tempos( track_rows( make_bgm( [track] ) ) )
+	fade = [value for time, value in rows if 0 < time <= 8]
+
+	# a later tempo change used to turn the ramp around
+	assert len( fade ) == 8
+	assert fade == sorted( fade, reverse = True )
+	assert fade[-1] == bpm_to_tempo( 160 )
+	assert rows[-1] == ( 20, bpm_to_tempo( 100 ) )
+
+def test_tempo_fade_is_cut_short_by_tempo_change():
+	track = tempo( 120 ) + tempo_fade( 40, 160 ) + delta( 20 ) + tempo( 100 ) + delta( 20 ) + note( 60 )
+
+	rows = tempos( track_rows( make_bgm( [track] ) ) )
+
+	assert rows[-1] == ( 20, bpm_to_tempo( 100 ) )
+	assert max( time for time, value in rows[:-1] ) < 20
+
+def test_tempo_fade_rounds_to_microseconds():
+	track = tempo( 100 ) + tempo_fade( 2, 101 ) + delta( 4 ) + note( 60 )
+
+	rows = tempos( track_rows( make_bgm( [track] ) ) )
+
+	# 100.5 BPM is 597014.9 microseconds per beat, and 101 BPM 594059.4
+	assert rows == [( 0, 600000 ), ( 1, 597015 ), ( 2, 594059 )]
+
+def test_tempo_fade_keeps_following_delta_time():
+	rows = [( 10, EventTypes.TEMPO_FADE, 0, 4, 130 ), ( 20, EventTypes.NOTE_ON, 0, 60, 100 )]
+
+	events = read_track( b''.join( track2smf( iter( rows ), 0 ) ) )
+
+	assert ( 20, bytes( ( 0x90, 60, 100 ) ) ) in events
+
+def test_tempo_fade_in_song_keeps_note_times():
+	track = tempo( 120 ) + delta( 10 ) + tempo_fade( 4, 130 ) + delta( 10 ) + note( 60, 100, 10 )
+
+	smf_format, tracks = read_smf( convert_to_bytes( make_bgm( [track] ), 0 ) )
+	notes = [event for event in tracks[0] if event[1][0] & 0xf0 in ( 0x80, 0x90 )]
+
+	assert notes == [( 20, bytes( ( 0x90, 60, 100 ) ) ), ( 30, bytes( ( 0x80, 60, 100 ) ) )]
+
+#-----------------------------------------------------------
+# volume fades
+
+def test_subvolume_fade_target_is_clamped():
+	# targets above 127 occur in the game's songs
+	track = cmd( 0xe9, 'B', 100 ) + cmd( 0xf6, 'HB', 8, 0xc8 ) + delta( 10 ) + note( 60 )
+
+	events = read_smf( convert_to_bytes( make_bgm( [track] ), 0 ) )[1][0]
+	levels = [event[2] for time, event in events if event[0] == 0xb0 and event[1] == 11]
+
+	assert levels[0] == 100
+	assert levels[-1] == 127
+	assert levels == sorted( levels )
+
+#-----------------------------------------------------------
+# output paths
+
+def test_format_0_merges_channel_tracks():
+	data = make_bgm( [note( 60 ) + delta( 10 ) + note( 62 ) + delta( 10 ), delta( 5 ) + note( 61 ) + delta( 10 )] )
+	end_of_track = b'\xff\x2f\x00'
+
+	smf_format, merged = read_smf( convert_to_bytes( data, 0, ConvertOptions( smf_format = 0 ) ) )
+	events = merged[0]
+	separate = [event for track in read_smf( convert_to_bytes( data, 0 ) )[1] for event in track]
+
+	assert ( smf_format, len( merged ) ) == ( 0, 1 )
+	assert [time for time, event in events] == sorted( time for time, event in events )
+	assert events[-1] == ( 20, end_of_track )
+	assert sorted( events[:-1] ) == sorted( event for event in separate if event[1] != end_of_track )
+
+	# each channel's events keep their order, with its setup before its first note
+	for channel in range( 2 ):
+		channel_events = [event for event in events if event[1][0] < 0xf0 and event[1][0] & 0x0f == channel]
+		assert channel_events == [event for event in separate if event[1][0] < 0xf0 and event[1][0] & 0x0f == channel]
+		assert channel_events[0][1][0] == 0xb0 | channel
+
+def synth_song() -> bytes:
+	return synth_bgm.make_bgm( subsegments = 4, tracks = 6, notes = 16, drum_tracks = 2 )
+
+@pytest.mark.parametrize( 'smf_format', ( 0, 1 ) )
+def test_parallel_tracks_match_serial( smf_format ):
+	data = synth_song()
+	options = ConvertOptions( translate_drums = True, smf_format = smf_format )
+	out = io.BytesIO()
+
+	convert_to_stream( data, 0, out, options, jobs = 2 )
+
+	assert out.getvalue() == convert_to_bytes( data, 0, options )
+
+def test_parallel_tracks_count_stats():
+	data = synth_song()
+	options = ConvertOptions( translate_drums = True )
+	serial = ConvertStats()
+	parallel = ConvertStats()
+
+	convert_to_stream( data, 0, io.BytesIO(), options, serial )
+	convert_to_stream( data, 0, io.BytesIO(), options, parallel, jobs = 2 )
+
+	# workers don't share the phrase cache, so they may read phrases again
+	assert parallel.detours == serial.detours
+	assert parallel.bytes_read >= serial.bytes_read
+	assert parallel.events == serial.events
+
+@pytest.mark.parametrize( 'smf_format, optimize', ( ( 1, False ), ( 1, True ), ( 0, False ) ) )
+def test_ir_round_trip( tmp_path, smf_format, optimize ):
+	data = synth_song()
+	ir_path = str( tmp_path / 'song.ir' )
+
+	with open( ir_path, 'wb' ) as f:
+		dump_ir( data, 0, f, ConvertOptions( translate_drums = True ) )
+
+	options = ConvertOptions( translate_drums = True, smf_format = smf_format, optimize = optimize )
+	out = io.BytesIO()
+	convert_ir( IrFile( ir_path ), out, options )
+
+	assert out.getvalue() == convert_to_bytes( data, 0, options )
+
+def test_ir_generated_events_keep_source_subsegment( tmp_path ):
+	# the tremolo of the note at tick 6 sets in at tick 10, where the second play begins
+	track = cmd( 0xf0, 'BBB', 4, 0, 100 ) + delta( 6 ) + note( 60 ) + delta( 4 )
+	ir_path = str( tmp_path / 'song.ir' )
+
+	with open( ir_path, 'wb' ) as f:
+		dump_ir( make_bgm( [track], plays = 2, copies = True ), 0, f, ConvertOptions( tremolo = True ) )
+
+	columns = IrFile( ir_path ).columns
+	rows = zip( columns['time'], columns['type'], columns['param1'], columns['param2'], columns['subsegment'] )
+
+	assert [( time, param2, subsegment ) for time, event_type, param1, param2, subsegment in rows
+		if event_type == EventTypes.CC and param1 == 1] == [( 10, 100, 0 ), ( 16, 0, 1 ), ( 20, 100, 1 )]
+
+@pytest.mark.parametrize( 'smf_format', ( 0, 1 ) )
+def test_mido_file_matches_native_bytes( smf_format ):
+	pytest.importorskip( 'mido' )
+	data = synth_song()
+	options = ConvertOptions( translate_drums = True, smf_format = smf_format )
+	out = io.BytesIO()
+
+	convert( data, 0, options ).save( file = out )
+
+	assert out.getvalue() == convert_to_bytes( data, 0, options )
@@ -0,0 +1,58 @@
+import json, struct
+import pytest
+
+import pm64_to_midi
+from pm64_to_midi import inspect_main, inspect_song
+from bgm_builder import delta, make_bgm, note, tempo, tempo_fade
+
+#-----------------------------------------------------------
+
+def messages( report: dict ) -> list:
+	return [issue['message'] for issue in report['issues']]
+
+def test_track_offset_outside_file():
+	data = bytearray( make_bgm( [note( 60 ) + delta( 10 ), note( 62 ) + delta( 10 )] ) )
+	seg_ofs = struct.unpack_from( '>H', data, 0x14 )[0] << 2
+	sub_ofs = seg_ofs + ( struct.unpack_from( '>H', data, seg_ofs + 2 )[0] << 2 )
+	struct.pack_into( '>H', data, sub_ofs + 4, 0xfff0 )
+
+	report = inspect_song( bytes( data ) )
+
+	assert report['issues'] == [
+		{ 'segment': 0, 'channel': 1, 'offset': sub_ofs + 4, 'message': 'track is outside the file' }]
+	assert report['segments'][0]['channels'] == [0]
+
+@pytest.mark.parametrize( 'track, cut, message', (
+	( note( 60 ) + delta( 10 ), 1, 'track runs past the end of the file' ),
+	( delta( 10 ) + note( 60 ), 2, 'note runs past the end of the file' ),
+	( tempo( 120 ) + tempo_fade( 8, 160 ), 3, 'command E4 runs past the end of the file' ),
+) )
+def test_truncated_track( track, cut, message ):
+	data = make_bgm( [track] )[:-cut]
+
+	assert messages( inspect_song( data ) ) == [message]
+
+def test_failing_song_does_not_stop_the_run( tmp_path, monkeypatch, capsys ):
+	paths = []
+	calls = []
+
+	for name in ( 'bad.bgm', 'good.bgm' ):
+		paths.append( tmp_path / name )
+		paths[-1].write_bytes( make_bgm( [note( 60 ) + delta( 10 )] ) )
+
+	def inspect_song_failing( reader ) -> dict:
+		# the files are inspected in order, so only bad.bgm fails
+		if not calls:
+			calls.append( reader )
+			raise IndexError( 'index out of range' )
+		return inspect_song( reader )
+
+	monkeypatch.setattr( pm64_to_midi, 'inspect_song', inspect_song_failing )
+
+	with pytest.raises( SystemExit ):
+		inspect_main( [str( path ) for path in paths] )
+
+	reports = [json.loads( line ) for line in capsys.readouterr().out.splitlines()]
+
+	assert reports[0]['error'] == 'IndexError: index out of range'
+	assert reports[1]['issues'] == []
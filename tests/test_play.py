@@ -0,0 +1,40 @@
+import pytest
+
+import pm64_to_midi
+from pm64_to_midi import RecorderSink, play_main, play_song
+from bgm_builder import delta, make_bgm, note, tempo
+
+#-----------------------------------------------------------
+
+def test_play_song_sends_messages_on_time():
+	# at 240 BPM and 48 ticks per beat, 12 ticks last 62.5 ms
+	track = tempo( 240 ) + note( 60, 100, 6 ) + delta( 12 ) + note( 62, 100, 6 ) + delta( 12 )
+	sink = RecorderSink()
+
+	report = play_song( make_bgm( [track] ), 0, sink, lookahead = 0.02 )
+	notes = [( seconds, message ) for seconds, message in sink.messages if message[0] & 0xe0 == 0x80]
+
+	assert [message for seconds, message in notes] == [
+		bytes( ( 0x90, 60, 100 ) ), bytes( ( 0x80, 60, 100 ) ), bytes( ( 0x90, 62, 100 ) ), bytes( ( 0x80, 62, 100 ) )]
+	assert abs( notes[1][0] - notes[0][0] - 0.03125 ) < 0.02
+	assert abs( notes[2][0] - notes[0][0] - 0.0625 ) < 0.02
+
+	assert set( report ) == { 'messages', 'start_latency', 'mean', 'p99', 'max' }
+	assert report['messages'] == len( sink.messages )
+	assert 0 <= report['mean'] <= report['max'] and report['p99'] <= report['max']
+	assert report['start_latency'] >= 0
+
+def test_interrupted_play_exits_quietly( tmp_path, monkeypatch, capsys ):
+	in_file = tmp_path / 'song.bgm'
+	in_file.write_bytes( make_bgm( [note( 60 ) + delta( 10 )] ) )
+
+	def play_song_interrupted( *args ) -> dict:
+		raise KeyboardInterrupt
+
+	monkeypatch.setattr( pm64_to_midi, 'play_song', play_song_interrupted )
+
+	with pytest.raises( SystemExit ) as e:
+		play_main( ['-i', str( in_file ), '-s', '0', '--raw', str( tmp_path / 'out.raw' )] )
+
+	assert e.value.code == 130
+	assert capsys.readouterr() == ( '', '' )